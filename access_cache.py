@@ -0,0 +1,111 @@
+"""
+In-process cache of the files' BLP labels, so that a BLP decision on a cache hit makes no DB round-trip.
+
+Entries are invalidated when the file is created or deleted through this process. Every gunicorn worker has its own
+cache, so a file that was deleted and created again (with another label) through another worker could have a stale
+label here. Entries therefore expire after max_age seconds, which bounds how long such a label is enforced.
+"""
+import sys
+import time
+import threading
+from collections import OrderedDict, namedtuple
+from orm.file import File
+
+
+this = sys.modules[__name__]
+this.files = None
+
+# The parts of a File row that are needed in order to make a BLP decision
+CachedFile = namedtuple('CachedFile', ['id', 'filename', 'level', 'compartments', 'owner_id'])
+
+
+class LruCache(object):
+    """
+    A bounded, thread safe LRU mapping with expiring entries, that counts its hits and misses
+    """
+    def __init__(self, max_entries, max_age):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[1] >= self.max_age:
+                self.misses += 1
+                return None
+            value = entry[0]
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+
+            # Evict the least recently used entries
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'max_age': self.max_age,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+def init(max_entries=10000, max_age=1.0):
+    """
+    Must be called whenever the DB is (re)initialized, since the rows of a previous DB are meaningless for the new one.
+    max_age is in seconds, 0 disables the cache.
+    """
+    this.files = LruCache(max_entries, max_age)
+
+
+def get_file(session, filename):
+    """
+    Returns a CachedFile or None if the file doesn't exist.
+    The DB is queried only on a cache miss.
+    """
+    cached_file = this.files.get(filename)
+    if cached_file is not None:
+        return cached_file
+
+    file = session.query(File).filter(File.filename == filename).one_or_none()
+    if not file:
+        return None
+
+    cached_file = put_file(file)
+
+    return cached_file
+
+
+def put_file(file):
+    cached_file = CachedFile(id=file.id, filename=file.filename, level=file.level, compartments=file.compartments, owner_id=file.owner_id)
+    this.files.put(file.filename, cached_file)
+
+    return cached_file
+
+
+def invalidate_file(filename):
+    this.files.invalidate(filename)
+
+
+def stats():
+    return {
+        'files': this.files.stats()
+    }
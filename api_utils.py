@@ -8,6 +8,8 @@ class ApiErorrCode(enum.Enum):
     UNAUTHORIZED = 3
     FILE_ALREADY_EXISTS = 4
     FILE_NOT_EXISTS = 5
+    INVALID_OFFSET = 6
+    BUSY = 7
 
 
 def api_error(http_code=400, api_result_code=None, error_message=None):
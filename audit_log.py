@@ -0,0 +1,327 @@
+"""
+Append-only audit log of the BLP access decisions.
+
+Requests only put records into an in-memory queue. A background writer thread takes them in batches and appends
+them (as JSON lines) to the active segment file, without an fsync per record. A segment that reaches its max size
+is rotated: it's gzipped and renamed after the time range of its records, so that queries can skip it by its name.
+When the queue is full, a request waits up to put_timeout for room (backpressure) and then fails with AuditLogFull,
+so that no decision goes unaudited. Dropping the record instead (and counting it) is an opt-in, with drop_when_full.
+
+Every process (e.g. gunicorn worker) writes its own segments. Query the log with:
+    python audit_log.py --log-dir audit --since 2026-01-01T00:00:00 --user-id 3
+"""
+import sys
+import os
+import re
+import json
+import gzip
+import time
+import queue
+import shutil
+import argparse
+import datetime
+import threading
+import logging
+import metrics
+from orm.level import compartment_names
+
+
+this = sys.modules[__name__]
+this.log_dir = None
+this.records_queue = None
+this.writer = None
+this.put_timeout = None
+this.drop_when_full = False
+
+# Active segments are named audit-<first record time ns>-<pid>.jsonl,
+# rotated ones audit-<first record time ns>-<last record time ns>-<pid>.jsonl.gz
+ACTIVE_SEGMENT_RE = re.compile(r'^audit-(\d+)-(\d+)\.jsonl$')
+ROTATED_SEGMENT_RE = re.compile(r'^audit-(\d+)-(\d+)-(\d+)\.jsonl\.gz$')
+
+dropped_records = metrics.Counter('blp_audit_dropped_records_total', "Audit records that were dropped because the queue was full")
+
+
+class AuditLogFull(Exception):
+    """
+    The queue stayed full for put_timeout, so the decision couldn't be audited
+    """
+    pass
+
+
+class SegmentWriter(threading.Thread):
+    """
+    The background thread that writes the queued records into segments
+    """
+    _STOP = object()
+
+    def __init__(self, log_dir, records_queue, batch_size, flush_interval, segment_max_bytes):
+        super().__init__(name='audit-log-writer', daemon=True)
+        self.log_dir = log_dir
+        self.queue = records_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.segment_max_bytes = segment_max_bytes
+        self._fp = None
+        self._path = None
+        self._first_time = None
+        self._last_time = None
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            # Wait for the first record of a batch, then take whatever else is queued by now
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = any(record is self._STOP for record in batch)
+            records = [record for record in batch if record is not self._STOP]
+            try:
+                if records:
+                    self._write(records)
+                if stopping:
+                    self._rotate()
+            except Exception:
+                logging.getLogger(__name__).exception("Failed writing {} audit records".format(len(records)))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def stop(self):
+        self.queue.put(self._STOP)
+        self.join()
+
+    def _write(self, records):
+        if self._fp is None:
+            self._first_time = records[0]['time']
+            self._path = os.path.join(self.log_dir, 'audit-{}-{}.jsonl'.format(int(self._first_time * 1e9), os.getpid()))
+            self._fp = open(self._path, 'a', encoding='utf-8')
+
+        self._fp.write(''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records))
+        self._fp.flush()
+        self._last_time = records[-1]['time']
+
+        if self._fp.tell() >= self.segment_max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        if self._fp is None:
+            return
+
+        self._fp.close()
+        self._fp = None
+        rotated_filename = 'audit-{}-{}-{}.jsonl.gz'.format(int(self._first_time * 1e9), int(self._last_time * 1e9), os.getpid())
+        compress_segment(self._path, os.path.join(self.log_dir, rotated_filename))
+
+
+def compress_segment(path, rotated_path):
+    # Write the compressed segment under a temporary name, so that a crash never leaves a truncated .gz segment
+    temp_path = rotated_path + '.tmp'
+    with open(path, 'rb') as src, gzip.open(temp_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(temp_path, rotated_path)
+    os.unlink(path)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _compress_leftover_segments(log_dir):
+    """
+    Rotates the active segments of processes that aren't running anymore (e.g. that crashed), and of this process.
+    The time of their last record is only known by reading them.
+    """
+    for filename in os.listdir(log_dir):
+        match = ACTIVE_SEGMENT_RE.match(filename)
+        if not match:
+            continue
+        pid = int(match.group(2))
+        if pid != os.getpid() and _is_running(pid):
+            continue
+
+        path = os.path.join(log_dir, filename)
+        last_time = None
+        with open(path, encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    last_time = json.loads(line)['time']
+                except ValueError:
+                    # A record that was cut in the middle
+                    pass
+        if last_time is None:
+            os.unlink(path)
+            continue
+
+        rotated_filename = 'audit-{}-{}-{}.jsonl.gz'.format(match.group(1), int(last_time * 1e9), match.group(2))
+        compress_segment(path, os.path.join(log_dir, rotated_filename))
+
+
+def init(log_dir="audit", max_queue_size=10000, put_timeout=5.0, batch_size=1000, flush_interval=1.0, segment_max_bytes=64 * 1024 * 1024,
+         drop_when_full=False):
+    """
+    Starts the writer thread. Until init is called, recording is a no-op.
+    """
+    close()
+
+    os.makedirs(log_dir, exist_ok=True)
+    _compress_leftover_segments(log_dir)
+
+    this.log_dir = log_dir
+    this.put_timeout = put_timeout
+    this.drop_when_full = drop_when_full
+    this.records_queue = queue.Queue(maxsize=max_queue_size)
+    this.writer = SegmentWriter(log_dir, this.records_queue, batch_size, flush_interval, segment_max_bytes)
+    this.writer.start()
+
+
+def close():
+    """
+    Writes the queued records, rotates the active segment and stops the writer thread
+    """
+    if this.writer is None:
+        return
+
+    this.writer.stop()
+    this.writer = None
+    this.records_queue = None
+
+
+def flush():
+    """
+    Waits until all the records that were queued until now are written
+    """
+    if this.records_queue is not None:
+        this.records_queue.join()
+
+
+def record(user_id, user_level, user_compartments, rule, operation, filename, file_level, file_compartments, allowed):
+    """
+    Queues an access decision, with the labels (levels and compartments) that it was made by. Never blocks for more than put_timeout.
+    Raises AuditLogFull if the queue stayed full, unless drop_when_full.
+    """
+    records_queue = this.records_queue
+    if records_queue is None:
+        return
+
+    entry = {
+        'time': time.time(),
+        'user_id': user_id,
+        'user_level': user_level.name if user_level else None,
+        'user_compartments': compartment_names(user_compartments) if user_compartments is not None else None,
+        'rule': rule,
+        'operation': operation,
+        'filename': filename,
+        'file_level': file_level.name if file_level else None,
+        'file_compartments': compartment_names(file_compartments) if file_compartments is not None else None,
+        'allowed': allowed
+    }
+    try:
+        records_queue.put(entry, timeout=this.put_timeout)
+    except queue.Full:
+        if not this.drop_when_full:
+            raise AuditLogFull()
+        dropped_records.inc()
+
+
+def list_segments(log_dir, since=None, until=None):
+    """
+    Paths of the segments that may have records in [since, until] (in epoch seconds), oldest first
+    """
+    segments = []
+    for filename in os.listdir(log_dir):
+        match = ROTATED_SEGMENT_RE.match(filename)
+        if match:
+            first_time, last_time = int(match.group(1)) / 1e9, int(match.group(2)) / 1e9
+        else:
+            match = ACTIVE_SEGMENT_RE.match(filename)
+            if not match:
+                continue
+            first_time, last_time = int(match.group(1)) / 1e9, None
+
+        # Skip segments that are entirely out of the time range
+        if since is not None and last_time is not None and last_time < since:
+            continue
+        if until is not None and first_time > until:
+            continue
+
+        segments.append((first_time, os.path.join(log_dir, filename)))
+
+    return [path for first_time, path in sorted(segments)]
+
+
+def query(log_dir, since=None, until=None, user_id=None, filename=None):
+    """
+    Generator of the records that match the filters, segment by segment (the records of a segment are in time order).
+    Only one line of one segment is held in memory at a time.
+    """
+    for path in list_segments(log_dir, since, until):
+        opener = gzip.open if path.endswith('.gz') else open
+        try:
+            fp = opener(path, 'rt', encoding='utf-8')
+        except FileNotFoundError:
+            # Rotated meanwhile
+            continue
+
+        with fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The active segment might end with a record that is being written
+                    continue
+
+                if since is not None and entry['time'] < since:
+                    continue
+                if until is not None and entry['time'] > until:
+                    continue
+                if user_id is not None and entry['user_id'] != user_id:
+                    continue
+                if filename is not None and entry['filename'] != filename:
+                    continue
+
+                yield entry
+
+
+def _parse_time(value):
+    """
+    Epoch seconds or an ISO 8601 time (local time if it has no timezone)
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def _parse_user_id(value):
+    # User ids are integers, except for the ADMIN user
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query the BLP audit log, prints the matching records as JSON lines")
+    parser.add_argument('--log-dir', default='audit')
+    parser.add_argument('--since', type=_parse_time, help="Epoch seconds or ISO 8601 time")
+    parser.add_argument('--until', type=_parse_time, help="Epoch seconds or ISO 8601 time")
+    parser.add_argument('--user-id', type=_parse_user_id)
+    parser.add_argument('--filename')
+    args = parser.parse_args()
+
+    for entry in query(args.log_dir, args.since, args.until, args.user_id, args.filename):
+        sys.stdout.write(json.dumps(entry) + '\n')
@@ -1,6 +1,106 @@
-import hashlib, uuid
+import sys, os, hashlib, uuid, threading, time, calendar
 from functools import wraps
 from flask import _app_ctx_stack, request
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from werkzeug.exceptions import Unauthorized
+from api_utils import ApiErorrCode, api_error
+from orm.level import BlpLevel, BlpCompartment, NO_COMPARTMENTS
+from orm.revoked_user import RevokedUser
+import db_manager
+
+
+this = sys.modules[__name__]
+this.serializer = None
+this.token_max_age = None
+# Maps deleted user ids to the time of deletion. Tokens of these users that were issued before it are rejected.
+# The revocations are kept in the DB (RevokedUser), so that all the workers reject the tokens, and this is the
+# process's copy of them, which is reloaded at most every revocations_sync_interval seconds.
+this.revoked_users = {}
+this.revoked_users_lock = threading.Lock()
+this.revocations_sync_interval = None
+this.revocations_synced_at = None
+
+
+def init(secret_key=None, token_max_age=3600, revocations_sync_interval=1.0):
+    """
+    secret_key signs the access tokens and must be the same in all the server's workers.
+    Without one, a random key is generated and the tokens are valid only in this process (for main and the tests,
+    start_server requires BLP_SECRET_KEY).
+    A user that is deleted through another worker is rejected by this one after up to revocations_sync_interval seconds.
+    """
+    if not secret_key:
+        secret_key = os.urandom(32)
+
+    this.serializer = URLSafeTimedSerializer(secret_key, salt='blp-access-token')
+    this.token_max_age = token_max_age
+    with this.revoked_users_lock:
+        this.revoked_users = {}
+        this.revocations_sync_interval = revocations_sync_interval
+        this.revocations_synced_at = None
+
+
+def create_access_token(user_id, level, compartments=NO_COMPARTMENTS):
+    """
+    A signed and timestamped token, carrying the user's id and label (clearance level and compartments bitmask)
+    """
+    return this.serializer.dumps({'id': user_id, 'level': level.name, 'compartments': int(compartments)})
+
+
+def revoke_user(session, user_id):
+    """
+    Rejects all the tokens that were issued to the user until now.
+    The revocation is added to the session, and is seen by the other workers once the session is committed.
+    """
+    now = time.time()
+    session.merge(RevokedUser(user_id=user_id, revoked_at=now))
+
+    # Forget revocations that are older than any token which is still valid
+    session.query(RevokedUser).filter(RevokedUser.revoked_at < now - this.token_max_age).delete(synchronize_session=False)
+
+    with this.revoked_users_lock:
+        this.revoked_users[user_id] = now
+
+
+def _sync_revocations():
+    """
+    Reloads the revocations from the DB if the process's copy is older than revocations_sync_interval
+    """
+    now = time.monotonic()
+    synced_at = this.revocations_synced_at
+    if synced_at is not None and now - synced_at < this.revocations_sync_interval:
+        return
+    this.revocations_synced_at = now
+
+    with db_manager.session_scope() as session:
+        revoked_users = dict(session.query(RevokedUser.user_id, RevokedUser.revoked_at).filter(RevokedUser.revoked_at >= time.time() - this.token_max_age))
+
+    with this.revoked_users_lock:
+        # Keep the revocations of this process that may not be committed yet
+        for user_id, revoked_at in this.revoked_users.items():
+            revoked_users[user_id] = max(revoked_at, revoked_users.get(user_id, revoked_at))
+        this.revoked_users = revoked_users
+
+
+def _verify_access_token(token):
+    """
+    Returns the token's payload or None if the token is invalid, expired or revoked.
+    This touches the DB only for reloading the revocations, at most every revocations_sync_interval seconds.
+    """
+    try:
+        payload, issued_at = this.serializer.loads(token, max_age=this.token_max_age, return_timestamp=True)
+    except (SignatureExpired, BadSignature):
+        return None
+
+    _sync_revocations()
+
+    # The timestamp has a resolution of seconds, so a token issued in the second of the revocation is rejected too.
+    # itsdangerous returns it as a naive UTC datetime, which timestamp() would take as local time.
+    with this.revoked_users_lock:
+        revoked_at = this.revoked_users.get(payload['id'])
+    if revoked_at is not None and calendar.timegm(issued_at.utctimetuple()) <= revoked_at:
+        return None
+
+    return payload
 
 
 def pass_to_hash(password, salt=None):
@@ -14,26 +114,42 @@ def pass_to_hash(password, salt=None):
     return hashed_password, salt
 
 
-def requires_auth(admin_only=False):
+def requires_auth(admin_only=False, allow_admin=False):
     """
-    Verifies that the user_id was passed in the Authorization header
+    Verifies the access token that was passed in the Authorization header.
+    The ADMIN user has no BLP label (its level and compartments are None), so it's rejected by the endpoints that
+    enforce the BLP rules, unless they are admin_only or allow_admin (and handle the missing label).
     """
     def wrapper(func):
         @wraps(func)
         def decorated_view(*args, **kwargs):
-            # Get the user_id from the header
-            user_id = _get_user_id_from_header()
-            if not user_id:
-                raise Exception("Unauthorized")
+            def unauthorized():
+                return api_error(http_code=Unauthorized.code, api_result_code=ApiErorrCode.UNAUTHORIZED)
+
+            # Get the access token from the header
+            token = _get_token_from_header()
+            if not token:
+                return unauthorized()
 
-            # If this is an ADMIN endpoint but the user is not ADMIN, raise an exception.
-            # We assume an ADMIN user if the request has "ADMIN" in the Authorization header instead of the user's id
-            if admin_only and user_id != 'ADMIN':
-                raise Exception("Unauthorized")
+            # If this is an ADMIN endpoint but the user is not ADMIN (or the other way around), reject the request
+            if is_admin_token(token):
+                if not admin_only and not allow_admin:
+                    return unauthorized()
+                current_user = {'user_id': token, 'level': None, 'compartments': None}
+            elif admin_only:
+                return unauthorized()
+            else:
+                payload = _verify_access_token(token)
+                if not payload:
+                    return unauthorized()
+                current_user = {
+                    'user_id': payload['id'],
+                    'level': BlpLevel[payload['level']],
+                    'compartments': BlpCompartment(payload.get('compartments', 0))
+                }
 
             # Save the user data in the flask app context
-            # If it's not ADMIN, then cast to int
-            _app_ctx_stack.top.current_user = {'user_id': int(user_id) if user_id != 'ADMIN' else user_id}
+            _app_ctx_stack.top.current_user = current_user
 
             return func(*args, **kwargs)
 
@@ -41,16 +157,28 @@ def requires_auth(admin_only=False):
     return wrapper
 
 
-def _get_user_id_from_header():
+def is_admin_token(token):
     """
-    # TODO - Right now we take the user id from header.
-    # In a real production app we need to take from the Authorization header the access token of the user (which was generated in an OAuth process)
+    We assume an ADMIN user if the request has "ADMIN" in the Authorization header instead of an access token
     """
+    return token == 'ADMIN'
+
+
+def _get_token_from_header():
     auth = request.headers.get("Authorization", None)
-    user_id = auth
+    if auth and auth.startswith('Bearer '):
+        auth = auth[len('Bearer '):]
 
-    return user_id
+    return auth
 
 
 def get_current_user_id():
     return _app_ctx_stack.top.current_user['user_id']
+
+
+def get_current_user_level():
+    return _app_ctx_stack.top.current_user['level']
+
+
+def get_current_user_compartments():
+    return _app_ctx_stack.top.current_user['compartments']
@@ -0,0 +1,397 @@
+"""
+Load test / benchmark of the gateway endpoints.
+
+Seeds users and files, drives a mixed workload of login / create / read / write / append / delete requests
+from concurrent client threads, and reports the throughput and the p50 / p95 / p99 latencies of every endpoint.
+The workload runs either against the Flask app in this process, or against gunicorn (start_server:app) that is
+launched locally on the seeded DB and filesystem.
+
+Usage:
+    python benchmark.py --target inprocess --users 50 --files 500 --requests 5000 --threads 8 --output results.json
+    python benchmark.py --target gunicorn --workers 2 --threads 8 --output results.json --compare previous.json
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_MIX = 'read=55,write=10,append=15,create=8,delete=4,login=8'
+
+LEVELS = ['UNCLASSIFIED', 'RESTRICTED', 'SECRET', 'TOP_SECRET']
+
+
+class InProcessClient(object):
+    """
+    Sends requests to the Flask app through its test client
+    """
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, url, body=None, token=None):
+        headers = {'Authorization': token} if token else {}
+        rv = self.client.open(url, method=method, json=body, headers=headers)
+        rv.get_data()
+
+        return rv.status_code
+
+
+class HttpClient(object):
+    """
+    Sends requests to a server over a keep-alive HTTP connection
+    """
+    def __init__(self, host, port):
+        self.connection = http.client.HTTPConnection(host, port, timeout=60)
+
+    def request(self, method, url, body=None, token=None):
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = token
+
+        self.connection.request(method, url, body=json.dumps(body) if body is not None else None, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+
+        return response.status
+
+
+class Workload(object):
+    """
+    The seeded users and files, shared by all the client threads
+    """
+    def __init__(self, users, files, content):
+        # Dicts with email, password and token
+        self.users = users
+        # Maps filenames to the index of their owner in users
+        self.files = files
+        self.content = content
+        self._lock = threading.Lock()
+        self._counter = 0
+
+    def random_user(self):
+        return random.choice(self.users)
+
+    def random_file(self):
+        with self._lock:
+            return random.choice(list(self.files)) if self.files else None
+
+    def new_filename(self):
+        with self._lock:
+            self._counter += 1
+            return 'bench-new-{}-{}.txt'.format(os.getpid(), self._counter)
+
+    def add_file(self, filename, owner):
+        with self._lock:
+            self.files[filename] = owner
+
+    def pop_file(self):
+        """
+        Removes a random file from the workload and returns it with its owner
+        """
+        with self._lock:
+            if not self.files:
+                return None, None
+            filename = random.choice(list(self.files))
+
+            return filename, self.files.pop(filename)
+
+
+def run_operation(client, workload, op):
+    """
+    Runs a single operation. Returns (endpoint name, HTTP status).
+    """
+    user_index = random.randrange(len(workload.users))
+    user = workload.users[user_index]
+
+    if op == 'login':
+        return 'POST /login', client.request('POST', '/login', {'email': user['email'], 'password': user['password']})
+
+    if op == 'create':
+        filename = workload.new_filename()
+        status = client.request('POST', '/files', {'filename': filename}, user['token'])
+        if status == 200:
+            workload.add_file(filename, user_index)
+        return 'POST /files', status
+
+    if op == 'delete':
+        filename, owner = workload.pop_file()
+        if filename is None:
+            return None, None
+        return 'DELETE /files', client.request('DELETE', '/files', {'filename': filename}, workload.users[owner]['token'])
+
+    filename = workload.random_file()
+    if filename is None:
+        return None, None
+
+    if op == 'read':
+        return 'GET /files/<filename>', client.request('GET', '/files/{}'.format(urllib.parse.quote(filename)), None, user['token'])
+    if op == 'write':
+        return 'PUT /files', client.request('PUT', '/files', {'filename': filename, 'content': workload.content}, user['token'])
+    if op == 'append':
+        return 'PATCH /files', client.request('PATCH', '/files', {'filename': filename, 'content': '\n' + workload.content[:64]}, user['token'])
+
+    raise ValueError("Unknown operation {}".format(op))
+
+
+def parse_mix(mix):
+    ops, weights = [], []
+    for item in mix.split(','):
+        op, weight = item.split('=')
+        ops.append(op.strip())
+        weights.append(float(weight))
+
+    return ops, weights
+
+
+def run_workload(make_client, workload, ops, weights, requests, threads):
+    """
+    Runs the requests from concurrent client threads.
+    Returns the latencies (in seconds) and error counts of every endpoint, and the wall time of the run.
+    """
+    latencies = {}
+    errors = {}
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker():
+        client = make_client()
+        thread_latencies = {}
+        thread_errors = {}
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+
+            op = random.choices(ops, weights)[0]
+            started = time.perf_counter()
+            endpoint, status = run_operation(client, workload, op)
+            elapsed = time.perf_counter() - started
+            if endpoint is None:
+                continue
+
+            thread_latencies.setdefault(endpoint, []).append(elapsed)
+            # BLP denials (401) are expected results of a random workload, other failures are errors
+            if status >= 400 and status != 401:
+                thread_errors[endpoint] = thread_errors.get(endpoint, 0) + 1
+
+        with lock:
+            for endpoint, values in thread_latencies.items():
+                latencies.setdefault(endpoint, []).extend(values)
+            for endpoint, count in thread_errors.items():
+                errors[endpoint] = errors.get(endpoint, 0) + count
+
+    started = time.perf_counter()
+    worker_threads = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in worker_threads:
+        thread.start()
+    for thread in worker_threads:
+        thread.join()
+
+    return latencies, errors, time.perf_counter() - started
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, wall_time):
+    def summary(values, error_count):
+        values = sorted(values)
+        return {
+            'count': len(values),
+            'errors': error_count,
+            'throughput': len(values) / wall_time if wall_time else 0.0,
+            'mean_ms': 1000 * sum(values) / len(values) if values else None,
+            'p50_ms': 1000 * percentile(values, 50) if values else None,
+            'p95_ms': 1000 * percentile(values, 95) if values else None,
+            'p99_ms': 1000 * percentile(values, 99) if values else None
+        }
+
+    endpoints = {endpoint: summary(values, errors.get(endpoint, 0)) for endpoint, values in latencies.items()}
+    all_values = [value for values in latencies.values() for value in values]
+
+    return {
+        'wall_time_s': wall_time,
+        'total': summary(all_values, sum(errors.values())),
+        'endpoints': endpoints
+    }
+
+
+def seed(app, num_users, num_files, file_size):
+    """
+    Creates the users and files through the app, and logs the users in
+    """
+    client = app.test_client()
+    content = ''.join(random.choice(string.ascii_letters + ' \n') for _ in range(file_size))
+
+    users = []
+    for i in range(num_users):
+        user = {
+            'email': 'bench{}@blp.local'.format(i),
+            'password': 'Bench{}!'.format(i),
+            'name': 'Bench {}'.format(i),
+            'level': LEVELS[i % len(LEVELS)]
+        }
+        rv = client.post('/users', json=user, headers={'Authorization': 'ADMIN'})
+        assert rv.status_code == 200, rv.get_data()
+        rv = client.post('/login', json={'email': user['email'], 'password': user['password']})
+        user['token'] = rv.get_json()['token']
+        users.append(user)
+
+    files = {}
+    for i in range(num_files):
+        owner = i % num_users
+        filename = 'bench-{}.txt'.format(i)
+        rv = client.post('/files', json={'filename': filename}, headers={'Authorization': users[owner]['token']})
+        assert rv.status_code == 200, rv.get_data()
+        client.put('/files', json={'filename': filename, 'content': content}, headers={'Authorization': users[owner]['token']})
+        files[filename] = owner
+
+    return Workload(users, files, content)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(workdir, port, workers, threads, secret_key):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    env['BLP_SECRET_KEY'] = secret_key
+    env['BLP_WORKER_THREADS'] = str(threads)
+    # Like the gunicorn script. `python -m gunicorn` would be re-run by every process that the password hashing pool spawns,
+    # since its __main__ module isn't guarded by `if __name__ == '__main__'`
+    process = subprocess.Popen(
+        [sys.executable, '-c', 'import sys; from gunicorn.app.wsgiapp import run; sys.exit(run())', '--bind', '127.0.0.1:{}'.format(port), '--worker-class=gthread',
+         '--workers', str(workers), '--threads', str(threads), '--log-level', 'warning', 'start_server:app'],
+        cwd=workdir, env=env
+    )
+
+    # Wait for the server to accept connections
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("gunicorn exited with code {}".format(process.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+
+    process.terminate()
+    raise RuntimeError("gunicorn didn't start listening on port {}".format(port))
+
+
+def print_results(results, previous=None):
+    print("{:<24} {:>8} {:>7} {:>10} {:>9} {:>9} {:>9}".format('endpoint', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    rows = sorted(results['endpoints'].items()) + [('TOTAL', results['total'])]
+    for endpoint, summary in rows:
+        print("{:<24} {:>8} {:>7} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            endpoint, summary['count'], summary['errors'], summary['throughput'], summary['p50_ms'], summary['p95_ms'], summary['p99_ms']))
+
+        # Relative change from the previous run
+        previous_summary = previous['total'] if previous and endpoint == 'TOTAL' else (previous or {}).get('endpoints', {}).get(endpoint)
+        if previous_summary and previous_summary.get('count'):
+            def change(key):
+                old, new = previous_summary[key], summary[key]
+                return 100.0 * (new - old) / old if old else 0.0
+
+            print("{:<24} {:>8} {:>7} {:>+9.1f}% {:>+8.1f}% {:>+8.1f}% {:>+8.1f}%".format(
+                '  vs previous', '', '', change('throughput'), change('p50_ms'), change('p95_ms'), change('p99_ms')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the BLP gateway endpoints")
+    parser.add_argument('--target', choices=['inprocess', 'gunicorn'], default='inprocess')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--file-size', type=int, default=4096)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8, help="Client threads, and gunicorn threads per worker")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="Weights of the operations, e.g. {}".format(DEFAULT_MIX))
+    parser.add_argument('--seed', type=int, default=None, help="Random seed, for repeatable workloads")
+    parser.add_argument('--output', help="Save the results to this JSON file")
+    parser.add_argument('--compare', help="Compare with the results of a previous run (JSON file)")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    ops, weights = parse_mix(args.mix)
+    output = os.path.abspath(args.output) if args.output else None
+    compare = os.path.abspath(args.compare) if args.compare else None
+
+    # Everything runs in a temporary directory, since the DB and the filesystem are relative to the working directory
+    workdir = tempfile.mkdtemp(prefix='blp-bench-')
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import main as blp_main
+    import db_manager
+
+    secret_key = os.urandom(16).hex()
+    blp_main.create_db(engine_profile=db_manager.production_profile(args.threads))
+    blp_main.init_filemanager(True)
+    app = blp_main.start_flask(secret_key)
+
+    print("Seeding {} users and {} files in {}".format(args.users, args.files, workdir))
+    workload = seed(app, args.users, args.files, args.file_size)
+
+    server = None
+    try:
+        if args.target == 'gunicorn':
+            port = _free_port()
+            server = start_gunicorn(workdir, port, args.workers, args.threads, secret_key)
+
+            def make_client():
+                return HttpClient('127.0.0.1', port)
+        else:
+            def make_client():
+                return InProcessClient(app)
+
+        print("Running {} requests with {} client threads against {}".format(args.requests, args.threads, args.target))
+        latencies, errors, wall_time = run_workload(make_client, workload, ops, weights, args.requests, args.threads)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    results = summarize(latencies, errors, wall_time)
+    results['config'] = {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+
+    previous = None
+    if compare:
+        with open(compare) as fp:
+            previous = json.load(fp)
+    print_results(results, previous)
+
+    if output:
+        with open(output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
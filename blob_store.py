@@ -0,0 +1,117 @@
+"""
+Reference counting and garbage collection of the deduplicated blobs that file_manager stores.
+A blob's link count on disk is the authority on whether it's still in use. The DB reference counts are recorded
+after the file's lock was released, so they can drift from it (e.g. when concurrent writes of a file record their
+blobs in the opposite order of their renames). They only tell the garbage collection which blobs to check first.
+"""
+import sys
+import logging
+import threading
+import db_manager
+import file_manager
+from orm.blob import Blob
+from orm.file import File
+
+
+this = sys.modules[__name__]
+this.gc_thread = None
+this.gc_stop = None
+# The last blob that was checked by the sweep of the referenced blobs
+this.gc_sweep_cursor = None
+
+
+def set_file_blob(session, file, digest):
+    """
+    Points the file at the blob of its new content (None if its content isn't a blob anymore),
+    releasing the reference to the blob of its previous content. The caller commits the session.
+    """
+    # The file might have been written again since, then its latest writer records its blob. The blob of this
+    # write still gets a row (without references), so that the garbage collection checks it.
+    if digest and not file_manager.is_linked_to_blob(file.filename, digest):
+        if not session.query(Blob).get(digest):
+            session.add(Blob(sha256=digest, size=file_manager.get_blob_size(digest), refcount=0))
+        return
+
+    if file.blob_sha256 == digest:
+        return
+
+    # Release the previous blob
+    if file.blob_sha256:
+        session.query(Blob).filter(Blob.sha256 == file.blob_sha256).update({Blob.refcount: Blob.refcount - 1}, synchronize_session=False)
+    file.blob_sha256 = digest
+
+    # Reference the new blob, creating its row on its first reference
+    if digest:
+        updated = session.query(Blob).filter(Blob.sha256 == digest).update({Blob.refcount: Blob.refcount + 1}, synchronize_session=False)
+        if not updated:
+            session.add(Blob(sha256=digest, size=file_manager.get_blob_size(digest), refcount=1))
+
+
+def update_file_blob(filename, digest):
+    """
+    Like set_file_blob, in its own session
+    """
+    with db_manager.session_scope() as session:
+        file = session.query(File).filter(File.filename == filename).one_or_none()
+        if not file:
+            return
+
+        set_file_blob(session, file, digest)
+        session.commit()
+
+
+def collect_garbage(limit=1000):
+    """
+    Deletes blobs that no file is linked to. Returns the number of deleted blobs.
+    Up to limit blobs without references are checked, and up to limit referenced blobs are swept (continuing from
+    where the previous call stopped), since their reference counts may have drifted.
+    """
+    with db_manager.session_scope() as session:
+        digests = [digest for digest, in session.query(Blob.sha256).filter(Blob.refcount <= 0).limit(limit)]
+
+        query = session.query(Blob.sha256).filter(Blob.refcount > 0)
+        if this.gc_sweep_cursor:
+            query = query.filter(Blob.sha256 > this.gc_sweep_cursor)
+        swept = [digest for digest, in query.order_by(Blob.sha256).limit(limit)]
+        this.gc_sweep_cursor = swept[-1] if len(swept) == limit else None
+
+    deleted = 0
+    for digest in digests + swept:
+        with db_manager.session_scope() as session:
+            # Deleting the row holds the DB's write lock, so no writer can reference the blob until
+            # the blob is deleted from the disk
+            if not session.query(Blob).filter(Blob.sha256 == digest).delete(synchronize_session=False):
+                continue
+
+            # A file might still be linked to the blob if its reference wasn't recorded yet, keep it then
+            if file_manager.delete_blob(digest):
+                session.commit()
+                deleted += 1
+            else:
+                session.rollback()
+
+    return deleted
+
+
+def start_gc(interval=60):
+    """
+    Runs the garbage collection in a background thread every interval seconds
+    """
+    this.gc_stop = threading.Event()
+
+    def run():
+        while not this.gc_stop.wait(interval):
+            try:
+                collect_garbage()
+            except Exception:
+                logging.getLogger(__name__).exception("Blob garbage collection failed")
+
+    this.gc_thread = threading.Thread(target=run, name='blob-gc', daemon=True)
+    this.gc_thread.start()
+
+
+def stop_gc():
+    if this.gc_thread:
+        this.gc_stop.set()
+        this.gc_thread.join()
+        this.gc_thread = None
@@ -1,8 +1,95 @@
-def enforce_blp_read(user_level, file_level):
-    # Enforce BLP no read up
-    return user_level.value >= file_level.value
+import numpy as np
+from orm.level import BlpLevel, NO_COMPARTMENTS
+from orm.file import File
+import metrics
 
 
-def enforce_blp_write(user_level, file_level):
-    # Enforce BLP no write down
-    return user_level.value <= file_level.value
+def enforce_blp_read(user_level, file_level, user_compartments=NO_COMPARTMENTS, file_compartments=NO_COMPARTMENTS):
+    # Enforce BLP no read up: the user's label must dominate the file's label
+    allowed = dominates(user_level, user_compartments, file_level, file_compartments)
+    metrics.record_access_decision('read', allowed)
+
+    return allowed
+
+
+def enforce_blp_write(user_level, file_level, user_compartments=NO_COMPARTMENTS, file_compartments=NO_COMPARTMENTS):
+    # Enforce BLP no write down: the file's label must dominate the user's label
+    allowed = dominates(file_level, file_compartments, user_level, user_compartments)
+    metrics.record_access_decision('write', allowed)
+
+    return allowed
+
+
+def dominates(level, compartments, other_level, other_compartments):
+    """
+    A label (level, compartments) dominates another one if its level is at least the other's level
+    and it has all of the other's compartments (i.e. the other's bitmask has no bits outside of its bitmask)
+    """
+    return level.value >= other_level.value and not (int(other_compartments) & ~int(compartments))
+
+
+def readable_levels(user_level):
+    """
+    All the file levels that a user with the given level may read.
+    Used for evaluating the no read up rule in SQL, e.g. File.level.in_(readable_levels(user_level))
+    """
+    return [file_level for file_level in BlpLevel if file_level.value <= user_level.value]
+
+
+def readable_files_criteria(user_level, user_compartments):
+    """
+    SQL criteria of the files that a user may read (no read up), the same as enforce_blp_read:
+    a readable level and no compartments outside of the user's compartments
+    """
+    return [
+        File.level.in_(readable_levels(user_level)),
+        File.compartments.op('&')(~int(user_compartments)) == 0
+    ]
+
+
+# Max number of (user, file) cells that are evaluated at once, bounds the memory of the bulk evaluation
+ACCESS_MATRIX_CHUNK_CELLS = 4 * 1024 * 1024
+
+
+def iter_access_matrices(user_levels, file_levels, user_compartments=None, file_compartments=None, max_cells=ACCESS_MATRIX_CHUNK_CELLS):
+    """
+    Bulk evaluation of the BLP rules for every (user, file) pair, vectorized with NumPy.
+    Levels are arrays of BlpLevel values and compartments are arrays of bitmasks (None if there are none).
+    Yields (first user index, read matrix, write matrix) for consecutive chunks of users, where the matrices are
+    boolean arrays of (users in the chunk x files). A chunk has up to max_cells cells, but at least one user.
+    """
+    user_levels = np.asarray(user_levels, dtype=np.int64)
+    file_levels = np.asarray(file_levels, dtype=np.int64)
+    user_compartments = np.zeros(len(user_levels), dtype=np.int64) if user_compartments is None else np.asarray(user_compartments, dtype=np.int64)
+    file_compartments = np.zeros(len(file_levels), dtype=np.int64) if file_compartments is None else np.asarray(file_compartments, dtype=np.int64)
+
+    # Without any compartments, the labels are the levels only
+    has_compartments = user_compartments.any() or file_compartments.any()
+
+    chunk_size = max(1, max_cells // max(1, len(file_levels)))
+    for start in range(0, len(user_levels), chunk_size):
+        levels = user_levels[start:start + chunk_size, np.newaxis]
+        read = levels >= file_levels
+        write = levels <= file_levels
+
+        if has_compartments:
+            compartments = user_compartments[start:start + chunk_size, np.newaxis]
+            # Read: the file has no compartment outside of the user's. Write: the user has no compartment outside of the file's.
+            read &= (file_compartments & ~compartments) == 0
+            write &= (compartments & ~file_compartments) == 0
+
+        yield start, read, write
+
+
+def access_counts(user_levels, file_levels, user_compartments=None, file_compartments=None, max_cells=ACCESS_MATRIX_CHUNK_CELLS):
+    """
+    The number of files that every user may read and the number of files that every user may write,
+    as two arrays that are aligned with the users
+    """
+    readable = np.zeros(len(user_levels), dtype=np.int64)
+    writable = np.zeros(len(user_levels), dtype=np.int64)
+    for start, read, write in iter_access_matrices(user_levels, file_levels, user_compartments, file_compartments, max_cells):
+        readable[start:start + len(read)] = read.sum(axis=1)
+        writable[start:start + len(write)] = write.sum(axis=1)
+
+    return readable, writable
@@ -0,0 +1,180 @@
+"""
+Feed of the changes to files (create / write / append / delete), streamed to subscribers as server-sent events.
+
+Every event gets a sequence number and is kept in a bounded history. Subscribers get only the events of files that
+their label may read (BLP no read up), through a bounded buffer. A subscriber that falls behind until its buffer is
+full has its stream ended, and it resumes from the history when it reconnects with the id of the last event it got
+(the Last-Event-ID header, which browsers' EventSource sends by itself). An id that isn't in the history anymore
+(or that is of another process) gets a reset event instead, which tells the client to re-scan the files.
+
+The feed is per process, so under gunicorn a subscriber only sees the changes that were made through its own worker.
+"""
+import sys
+import os
+import json
+import time
+import queue
+import threading
+from collections import deque, namedtuple
+import blp_rules
+from orm.level import compartment_names
+
+
+this = sys.modules[__name__]
+this.lock = threading.Lock()
+this.history = None
+this.subscribers = set()
+this.last_sequence = 0
+# Identifies this process's sequence numbers, which start over on every start
+this.epoch = None
+this.max_buffered = None
+this.keepalive_interval = None
+
+EVENT_CREATE = 'create'
+EVENT_WRITE = 'write'
+EVENT_APPEND = 'append'
+EVENT_DELETE = 'delete'
+EVENT_RESET = 'reset'
+
+Event = namedtuple('Event', ['sequence', 'type', 'filename', 'level', 'compartments', 'user_id', 'time'])
+
+
+class Subscriber(object):
+    def __init__(self, level, compartments, max_buffered):
+        # None for the ADMIN user, who gets all the events
+        self.level = level
+        self.compartments = compartments
+        self.events = queue.Queue(maxsize=max_buffered)
+        self.overflowed = False
+        self.reset = False
+        # The last sequence number when the subscriber was registered
+        self.subscribed_sequence = None
+
+    def offer(self, event):
+        """
+        Buffers the event if the subscriber may read its file. Called while holding the feed's lock.
+        """
+        if self.overflowed:
+            return
+        # BLP no read up, without counting it as an access decision (it's only a filter)
+        if self.level is not None and not blp_rules.dominates(self.level, self.compartments, event.level, event.compartments):
+            return
+
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+
+def init(history_size=10000, max_buffered=1000, keepalive_interval=15.0):
+    with this.lock:
+        this.history = deque(maxlen=history_size)
+        this.subscribers = set()
+        this.last_sequence = 0
+        this.epoch = os.urandom(4).hex()
+        this.max_buffered = max_buffered
+        this.keepalive_interval = keepalive_interval
+
+
+def publish(event_type, filename, level, compartments, user_id):
+    """
+    Records a change and offers it to all the subscribers. A no-op until init is called.
+    """
+    with this.lock:
+        if this.history is None:
+            return
+
+        this.last_sequence += 1
+        event = Event(this.last_sequence, event_type, filename, level, compartments, user_id, time.time())
+        this.history.append(event)
+        for subscriber in this.subscribers:
+            subscriber.offer(event)
+
+
+def _event_id(sequence):
+    return '{}-{}'.format(this.epoch, sequence)
+
+
+def _parse_event_id(event_id):
+    """
+    Returns the sequence number of an event id of this process, None otherwise
+    """
+    epoch, _, sequence = (event_id or '').partition('-')
+    if epoch != this.epoch or not sequence.isdigit():
+        return None
+
+    return int(sequence)
+
+
+def subscribe(level, compartments, last_event_id=None):
+    """
+    Registers a subscriber with the given label. If last_event_id is given, the events that followed it are buffered
+    right away from the history, or the subscriber is marked for a reset if they can't all be resumed.
+    """
+    with this.lock:
+        subscriber = Subscriber(level, compartments, this.max_buffered)
+
+        if last_event_id:
+            sequence = _parse_event_id(last_event_id)
+            oldest_sequence = this.history[0].sequence if this.history else this.last_sequence + 1
+            if sequence is None or sequence > this.last_sequence or sequence < oldest_sequence - 1:
+                subscriber.reset = True
+            else:
+                for event in this.history:
+                    if event.sequence > sequence:
+                        subscriber.offer(event)
+                if subscriber.overflowed:
+                    subscriber = Subscriber(level, compartments, this.max_buffered)
+                    subscriber.reset = True
+
+        this.subscribers.add(subscriber)
+        subscriber.subscribed_sequence = this.last_sequence
+
+    return subscriber
+
+
+def unsubscribe(subscriber):
+    with this.lock:
+        this.subscribers.discard(subscriber)
+
+
+def _format_event(event):
+    data = {
+        'type': event.type,
+        'filename': event.filename,
+        'level': event.level.name,
+        'compartments': compartment_names(event.compartments),
+        'user_id': event.user_id,
+        'time': event.time
+    }
+
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(_event_id(event.sequence), event.type, json.dumps(data))
+
+
+def iter_stream(subscriber):
+    """
+    Generator of the subscriber's server-sent events. Ends after the buffered events if the subscriber fell behind.
+    """
+    try:
+        # Reconnect quickly, with the Last-Event-ID
+        yield 'retry: 1000\n\n'
+
+        if subscriber.reset:
+            # Its id is where the client resumes from after it re-scans
+            yield 'id: {}\nevent: {}\ndata: {{}}\n\n'.format(_event_id(subscriber.subscribed_sequence), EVENT_RESET)
+
+        while True:
+            # Events were dropped after the buffered ones, the client resumes from the history when it reconnects
+            if subscriber.overflowed and subscriber.events.empty():
+                return
+
+            try:
+                event = subscriber.events.get(timeout=this.keepalive_interval)
+            except queue.Empty:
+                # A comment, which also detects clients that disconnected
+                yield ': keepalive\n\n'
+                continue
+
+            yield _format_event(event)
+    finally:
+        unsubscribe(subscriber)
@@ -1,9 +1,11 @@
 import sys
+import time
 from contextlib import contextmanager
-from sqlalchemy import Column, Integer, String
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+import metrics
+import profiler
 
 
 this = sys.modules[__name__]
@@ -11,15 +13,100 @@ this.engine = None
 this.session_factory = None
 
 
-def init(db_filename=None):
+class EngineProfile(object):
+    """
+    Engine and SQLite connection settings.
+    A None value keeps the SQLAlchemy / SQLite default.
+    """
+    def __init__(self, echo=True, journal_mode=None, synchronous=None, cache_size=None, mmap_size=None, busy_timeout=None, pool_size=None):
+        self.echo = echo
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        # Negative value is in KiB, positive value is in pages (see sqlite's PRAGMA cache_size)
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        # Milliseconds to wait for a locked DB before failing with "database is locked"
+        self.busy_timeout = busy_timeout
+        # When set, up to pool_size connections are kept open (and more are opened while they are all checked out)
+        self.pool_size = pool_size
+
+    def pragmas(self):
+        pragmas = [
+            ('journal_mode', self.journal_mode),
+            ('synchronous', self.synchronous),
+            ('cache_size', self.cache_size),
+            ('mmap_size', self.mmap_size),
+            ('busy_timeout', self.busy_timeout)
+        ]
+
+        return [(name, value) for name, value in pragmas if value is not None]
+
+
+# The original settings, used by the unit tests and for debugging
+DEFAULT_PROFILE = EngineProfile()
+
+
+def production_profile(threads=8):
+    """
+    Settings for running under gunicorn gthread workers, with pool_size matching the worker's thread count.
+    WAL lets readers run concurrently with the single writer and synchronous=NORMAL is still safe in WAL mode.
+    """
+    return EngineProfile(
+        echo=False,
+        journal_mode='WAL',
+        synchronous='NORMAL',
+        cache_size=-64000,
+        mmap_size=256 * 1024 * 1024,
+        busy_timeout=5000,
+        pool_size=threads
+    )
+
+
+def init(db_filename=None, profile=None):
     if not db_filename:
         db_filename = "blp.db"
-    this.engine = create_engine('sqlite:///{}'.format(db_filename), echo=True)
+    if not profile:
+        profile = DEFAULT_PROFILE
 
-    this.session_factory = sessionmaker(bind=this.engine)
+    engine_kwargs = {}
+    if profile.pool_size:
+        # A connection is checked out by one session at a time and is never closed while it's in use. Threads beyond
+        # pool_size (e.g. blob_store's garbage collection) get overflow connections, which are closed when returned.
+        engine_kwargs['poolclass'] = QueuePool
+        engine_kwargs['pool_size'] = profile.pool_size
+        engine_kwargs['max_overflow'] = -1
+        engine_kwargs['connect_args'] = {'check_same_thread': False}
+    this.engine = create_engine('sqlite:///{}'.format(db_filename), echo=profile.echo, **engine_kwargs)
+
+    # Apply the pragmas on every new DBAPI connection
+    pragmas = profile.pragmas()
+    if pragmas:
+        @event.listens_for(this.engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas:
+                cursor.execute('PRAGMA {} = {}'.format(name, value))
+            cursor.close()
 
-    # from sqlalchemy import Table, Column, Integer, String, MetaData
-    # meta = MetaData()
+    # Count, time (and trace, for profiled requests) every statement
+    @event.listens_for(this.engine, 'before_cursor_execute')
+    def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+    @event.listens_for(this.engine, 'after_cursor_execute')
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info['statement_started'].pop()
+        metrics.observe_sql(duration)
+        profiler.record_sql(statement, parameters, duration)
+
+    @event.listens_for(this.engine, 'handle_error')
+    def discard_statement_timer(exception_context):
+        # A failed statement has no after_cursor_execute
+        started = exception_context.connection.info.get('statement_started') if exception_context.connection else None
+        if started:
+            started.pop()
+
+    this.session_factory = sessionmaker(bind=this.engine)
 
 
 @contextmanager
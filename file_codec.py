@@ -0,0 +1,153 @@
+"""
+The framed format of files that are compressed at rest.
+
+A framed file starts with MAGIC, followed by any number of frames. Every frame is a header
+(codec id, content length, stored length) followed by the stored (possibly compressed) bytes.
+Frames are independent of each other, so appending to a framed file only adds frames at its end,
+and reading a range of the content only decompresses the frames that overlap it.
+"""
+import struct
+import zlib
+import lzma
+
+
+MAGIC = b'BLPZ\x00\x01'
+
+FRAME_HEADER = struct.Struct('>BII')
+
+# Content of a single frame. Bounds the memory that is needed for compressing / decompressing a frame.
+MAX_FRAME_SIZE = 1024 * 1024
+
+CODEC_STORE = 'store'
+CODEC_ZLIB = 'zlib'
+CODEC_LZMA = 'lzma'
+
+CODEC_IDS = {
+    CODEC_STORE: 0,
+    CODEC_ZLIB: 1,
+    CODEC_LZMA: 2
+}
+CODEC_NAMES = {codec_id: codec for codec, codec_id in CODEC_IDS.items()}
+
+
+def _compress(codec_id, data):
+    if codec_id == CODEC_IDS[CODEC_ZLIB]:
+        return zlib.compress(data)
+    if codec_id == CODEC_IDS[CODEC_LZMA]:
+        return lzma.compress(data)
+
+    return bytes(data)
+
+
+def _decompress(codec_id, stored, content_length):
+    if codec_id == CODEC_IDS[CODEC_STORE]:
+        data = stored
+    elif codec_id == CODEC_IDS[CODEC_ZLIB]:
+        data = zlib.decompressobj().decompress(stored, content_length + 1)
+    elif codec_id == CODEC_IDS[CODEC_LZMA]:
+        data = lzma.LZMADecompressor().decompress(stored, content_length + 1)
+    else:
+        raise IOError("Unknown codec id {}".format(codec_id))
+
+    # Never trust the header blindly, e.g. a frame which decompresses to more than it declares
+    if len(data) != content_length:
+        raise IOError("Corrupted frame, expected {} bytes and got {}".format(content_length, len(data)))
+
+    return data
+
+
+def encode_frame(data, codec):
+    """
+    Returns the frame of data, stored as is if compressing it doesn't make it smaller
+    """
+    codec_id = CODEC_IDS[codec]
+    stored = _compress(codec_id, data)
+    if len(stored) >= len(data):
+        codec_id = CODEC_IDS[CODEC_STORE]
+        stored = bytes(data)
+
+    return FRAME_HEADER.pack(codec_id, len(data), len(stored)) + stored
+
+
+def is_framed(fp):
+    """
+    Checks the head of an open file and leaves it positioned at the beginning of its first frame (or of the file)
+    """
+    fp.seek(0)
+    if fp.read(len(MAGIC)) == MAGIC:
+        return True
+
+    fp.seek(0)
+    return False
+
+
+def iter_frames(fp):
+    """
+    Yields (codec id, content length, stored length) of every frame of a framed file,
+    with fp positioned at the frame's stored bytes. The caller may read them, they're skipped otherwise.
+    """
+    fp.seek(len(MAGIC))
+    position = len(MAGIC)
+    while True:
+        header = fp.read(FRAME_HEADER.size)
+        if not header:
+            return
+        if len(header) < FRAME_HEADER.size:
+            raise IOError("Truncated frame header")
+
+        codec_id, content_length, stored_length = FRAME_HEADER.unpack(header)
+        position += FRAME_HEADER.size
+        yield codec_id, content_length, stored_length
+
+        position += stored_length
+        fp.seek(position)
+
+
+def iter_content(fp, start=0, stop=None):
+    """
+    Yields the content bytes [start, stop) of a framed file, frame by frame.
+    Frames that are before start are skipped without being read.
+    """
+    offset = 0
+    for codec_id, content_length, stored_length in iter_frames(fp):
+        frame_start, frame_stop = offset, offset + content_length
+        offset = frame_stop
+        if frame_stop <= start:
+            continue
+        if stop is not None and frame_start >= stop:
+            return
+
+        data = _decompress(codec_id, fp.read(stored_length), content_length)
+        slice_start = max(start - frame_start, 0)
+        slice_stop = content_length if stop is None else min(stop - frame_start, content_length)
+
+        yield data[slice_start:slice_stop]
+
+
+def content_size(fp):
+    """
+    The size of the content of a framed file, from its frame headers only
+    """
+    return sum(content_length for codec_id, content_length, stored_length in iter_frames(fp))
+
+
+class FrameWriter(object):
+    """
+    Writes data as frames of up to MAX_FRAME_SIZE content bytes.
+    The data of every write() call is buffered until there's a full frame, close() writes the last frame.
+    """
+    def __init__(self, fp, codec):
+        self.fp = fp
+        self.codec = codec
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= MAX_FRAME_SIZE:
+            self.fp.write(encode_frame(self._buffer[:MAX_FRAME_SIZE], self.codec))
+            del self._buffer[:MAX_FRAME_SIZE]
+
+    def close(self):
+        if self._buffer:
+            self.fp.write(encode_frame(self._buffer, self.codec))
+            self._buffer = bytearray()
@@ -1,13 +1,335 @@
 import sys
 import os
 import shutil
+import hashlib
+import json
+import io
+import itertools
+import threading
+import uuid
+import file_codec
+import metrics
+from contextlib import contextmanager
+from collections import OrderedDict
 
 
 this = sys.modules[__name__]
 this.fs_dir = None
+this.shard_depth = 0
+this.content_cache = None
+this.file_locks = None
+this.durability = None
+this.dir_syncer = None
+this.compression = None
+this.compression_threshold = None
+this.dedup = False
 
+# Size of the chunks in which file contents are streamed
+CHUNK_SIZE = 64 * 1024
 
-def init(purge, fs_dir="fs"):
+# Number of hash-prefix subdirectory levels for new filesystems (each level has up to 256 subdirectories)
+DEFAULT_SHARD_DEPTH = 2
+
+# Durability levels of writes and appends:
+# NONE - writes are atomic (a reader sees either the old or the new content), but may be lost on a crash
+# BATCH - the written data is fsynced by every writer, the directory fsyncs of concurrent writers are batched
+# FULL - every writer fsyncs its data and its directory by itself
+DURABILITY_NONE = 'none'
+DURABILITY_BATCH = 'batch'
+DURABILITY_FULL = 'full'
+
+# Directory of the content-addressed blobs, for deduplication
+BLOBS_DIRNAME = '.blp-blobs'
+
+# Records the layout of the filesystem. A filesystem without it is an old, flat one (shard depth 0).
+LAYOUT_FILENAME = '.blp_layout.json'
+
+
+class ContentCache(object):
+    """
+    An LRU cache of file contents, bounded by the total size of the cached files.
+    Every entry is validated against the file's current stat, so a change that was made by another process
+    (e.g. another gunicorn worker) is never served from the cache.
+    """
+    def __init__(self, max_bytes, max_entry_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Maps filenames to (stat key, size, content)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stat_key(stat):
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def get(self, filename, stat):
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None or entry[0] != self._stat_key(stat):
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(filename)
+            self.hits += 1
+
+            return entry[2]
+
+    def put(self, filename, stat, content, size=None):
+        size = size if size is not None else stat.st_size
+        if size > self.max_entry_bytes or size > self.max_bytes:
+            self.invalidate(filename)
+            return
+
+        with self._lock:
+            self._pop(filename)
+            self._entries[filename] = (self._stat_key(stat), size, content)
+            self.resident_bytes += size
+
+            # Evict the least recently used files
+            while self.resident_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.resident_bytes -= evicted_size
+
+    def invalidate(self, filename):
+        with self._lock:
+            self._pop(filename)
+
+    def _pop(self, filename):
+        entry = self._entries.pop(filename, None)
+        if entry is not None:
+            self.resident_bytes -= entry[1]
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'resident_bytes': self.resident_bytes,
+                'max_bytes': self.max_bytes,
+                'max_entry_bytes': self.max_entry_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / requests if requests else 0.0
+            }
+
+
+class FileLock(object):
+    """
+    The lock of a single file, together with the appends that wait to be written to it
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Number of threads that hold or wait for this lock
+        self.users = 0
+
+        # Every append gets a ticket. Guarded by pending_lock.
+        self.pending_lock = threading.Lock()
+        self.pending_appends = []
+        self.last_ticket = 0
+        # The last ticket that was written, and the ticket ranges of groups that failed. Guarded by lock.
+        self.written_ticket = 0
+        self.failed_groups = []
+
+
+class FileLocks(object):
+    """
+    Per-filename locks, so that writers of the same file are serialized without blocking writers of other files.
+    A lock exists only while some thread holds or waits for it.
+    """
+    def __init__(self):
+        self._locks = {}
+        self._mutex = threading.Lock()
+
+    @contextmanager
+    def acquire(self, filename):
+        """
+        Yields the FileLock of the file, without locking it
+        """
+        with self._mutex:
+            file_lock = self._locks.get(filename)
+            if file_lock is None:
+                file_lock = self._locks[filename] = FileLock()
+            file_lock.users += 1
+
+        try:
+            yield file_lock
+        finally:
+            with self._mutex:
+                file_lock.users -= 1
+                if not file_lock.users:
+                    del self._locks[filename]
+
+    @contextmanager
+    def lock(self, filename):
+        with self.acquire(filename) as file_lock:
+            with file_lock.lock:
+                yield file_lock
+
+
+class FileUndo(object):
+    """
+    Reverts a single change of a file (create, write, append or delete) without copying the file.
+    It's created right before the change: the current version of the file is kept aside as a hard link (writes replace
+    the file with a new one, so the kept version isn't changed), or for an append, only the file's size is kept.
+    The change is reverted only if the file wasn't changed again since (by another request), whose change wins then.
+    """
+    def __init__(self, filename, append=False):
+        self.filename = filename
+        self.filepath = get_filepath(filename)
+        self.saved_filepath = None
+        self.size = None
+        self.changed_version = None
+
+        with this.file_locks.lock(filename):
+            try:
+                if append:
+                    self.size = os.stat(self.filepath).st_size
+                else:
+                    saved_filepath = os.path.join(os.path.dirname(self.filepath), '.blp-{}.undo'.format(uuid.uuid4().hex))
+                    os.link(self.filepath, saved_filepath)
+                    self.saved_filepath = saved_filepath
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _version(filepath):
+        try:
+            stat = os.stat(filepath)
+        except FileNotFoundError:
+            return None
+
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def changed(self):
+        """
+        Must be called right after the change
+        """
+        self.changed_version = self._version(self.filepath)
+
+    def undo(self):
+        with this.file_locks.lock(self.filename):
+            if self._version(self.filepath) == self.changed_version:
+                if self.size is not None:
+                    # Drops the appended bytes (or frames)
+                    os.truncate(self.filepath, self.size)
+                elif self.saved_filepath:
+                    os.replace(self.saved_filepath, self.filepath)
+                    self.saved_filepath = None
+                elif self.changed_version is not None:
+                    # The file didn't exist before the change
+                    os.unlink(self.filepath)
+                this.content_cache.invalidate(self.filename)
+        _sync_dir(os.path.dirname(self.filepath))
+
+        self.discard()
+
+    def discard(self):
+        """
+        Deletes the kept version once the change doesn't have to be reverted anymore
+        """
+        if self.saved_filepath:
+            try:
+                os.unlink(self.saved_filepath)
+            except FileNotFoundError:
+                pass
+            self.saved_filepath = None
+
+
+class GroupSyncer(object):
+    """
+    Batches fsyncs that are requested concurrently (group commit):
+    one of the requesting threads fsyncs all the paths that were requested until then, while the others wait for it.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = set()
+        # Requests of generation N are fsynced by the batch that completes generation N
+        self._generation = 0
+        self._synced_generation = -1
+        self._syncing = False
+        self._errors = {}
+
+    def sync(self, path):
+        with self._cond:
+            self._pending.add(path)
+            generation = self._generation
+
+            while True:
+                # The batch that contains the path was synced
+                if self._synced_generation >= generation:
+                    error = self._errors.get(generation)
+                    if error:
+                        raise IOError("fsync of {} failed: {}".format(path, error))
+                    return
+
+                # Become the syncer of everything that is pending
+                if not self._syncing:
+                    self._syncing = True
+                    batch = self._pending
+                    self._pending = set()
+                    batch_generation = self._generation
+                    self._generation += 1
+                    break
+
+                self._cond.wait()
+
+        error = None
+        try:
+            for batch_path in batch:
+                _fsync_path(batch_path)
+        except OSError as e:
+            error = e
+
+        with self._cond:
+            self._syncing = False
+            self._synced_generation = batch_generation
+            if error:
+                self._errors[batch_generation] = error
+            # Keep the errors of recent batches only
+            for old_generation in [g for g in self._errors if g < batch_generation - 1000]:
+                del self._errors[old_generation]
+            self._cond.notify_all()
+
+        if error:
+            raise IOError("fsync of {} failed: {}".format(path, error))
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def init(purge, fs_dir="fs", shard_depth=None, cache_max_bytes=64 * 1024 * 1024, cache_max_entry_bytes=1024 * 1024, durability=DURABILITY_NONE,
+         compression=None, compression_threshold=4096, dedup=False):
+    """
+    shard_depth is taken from the filesystem's layout file. It may be given in order to verify the layout,
+    or to choose the layout of a new filesystem (DEFAULT_SHARD_DEPTH otherwise).
+    An existing filesystem can be moved to another layout offline with migrate_fs.py.
+    Files of up to cache_max_entry_bytes are kept in an in-memory cache of up to cache_max_bytes.
+    durability is one of the DURABILITY_* levels.
+    compression is None or a file_codec codec (zlib / lzma), used for contents of at least compression_threshold bytes.
+    Files that were written with or without compression are readable either way.
+    With dedup, whole-file writes are stored as content-addressed blobs (by SHA-256) which files with identical
+    content share through hard links. The blobs' reference counts are kept in the DB by blob_store.
+    """
+    if durability not in (DURABILITY_NONE, DURABILITY_BATCH, DURABILITY_FULL):
+        raise ValueError("Unknown durability {}".format(durability))
+    if compression not in (None, file_codec.CODEC_ZLIB, file_codec.CODEC_LZMA):
+        raise ValueError("Unknown compression {}".format(compression))
+
+    this.content_cache = ContentCache(cache_max_bytes, cache_max_entry_bytes)
+    this.file_locks = FileLocks()
+    this.durability = durability
+    this.dir_syncer = GroupSyncer()
+    this.compression = compression
+    this.compression_threshold = compression_threshold
+    this.dedup = dedup
     this.fs_dir = fs_dir
     if os.path.exists(this.fs_dir):
         if purge:
@@ -16,67 +338,594 @@ def init(purge, fs_dir="fs"):
     else:
         os.makedirs(this.fs_dir)
 
+    # A new (empty) filesystem gets the requested layout
+    if not _has_entries(this.fs_dir):
+        write_layout(this.fs_dir, shard_depth if shard_depth is not None else DEFAULT_SHARD_DEPTH)
+
+    this.shard_depth = read_layout(this.fs_dir)
+    if shard_depth is not None and shard_depth != this.shard_depth:
+        raise ValueError("Filesystem {} has a shard depth of {} and not {}, migrate it with migrate_fs.py".format(this.fs_dir, this.shard_depth, shard_depth))
+
+
+def _has_entries(dirpath):
+    with os.scandir(dirpath) as entries:
+        return next(entries, None) is not None
+
+
+def read_layout(fs_dir):
+    try:
+        with open(os.path.join(fs_dir, LAYOUT_FILENAME), "r") as fp:
+            return json.load(fp)['shard_depth']
+    except FileNotFoundError:
+        return 0
+
+
+def write_layout(fs_dir, shard_depth):
+    with open(os.path.join(fs_dir, LAYOUT_FILENAME), "w") as fp:
+        json.dump({'shard_depth': shard_depth}, fp)
+
+
+def get_filepath(filename, fs_dir=None, shard_depth=None):
+    """
+    Resolves a filename to its path on disk.
+    With sharding, the file is placed under subdirectories named after the first bytes of its name's hash,
+    e.g. fs/3f/a2/filename for a shard depth of 2, which keeps every directory small.
+    """
+    fs_dir = fs_dir if fs_dir is not None else this.fs_dir
+    shard_depth = shard_depth if shard_depth is not None else this.shard_depth
+    if not shard_depth:
+        return os.path.join(fs_dir, filename)
+
+    digest = hashlib.sha1(filename.encode('utf-8')).hexdigest()
+    shards = [digest[i * 2:i * 2 + 2] for i in range(shard_depth)]
+
+    return os.path.join(fs_dir, *shards, filename)
+
+
+def get_blob_path(digest):
+    return os.path.join(this.fs_dir, BLOBS_DIRNAME, digest[:2], digest[2:4], digest)
+
+
+def get_blob_size(digest):
+    try:
+        return os.stat(get_blob_path(digest)).st_size
+    except FileNotFoundError:
+        return 0
+
+
+def delete_blob(digest):
+    """
+    Deletes the blob if no file is linked to it anymore. Returns whether the blob doesn't exist anymore.
+    """
+    blob_path = get_blob_path(digest)
+    try:
+        # The link count is the authority: a file that shares the blob's storage is a hard link to it
+        if os.stat(blob_path).st_nlink > 1:
+            return False
+        os.unlink(blob_path)
+    except FileNotFoundError:
+        pass
+
+    return True
+
+
+def is_linked_to_blob(filename, digest):
+    """
+    Whether the file's current version is (a hard link to) the blob of the digest
+    """
+    try:
+        return os.path.samefile(get_filepath(filename), get_blob_path(digest))
+    except FileNotFoundError:
+        return False
+
 
 def purge_filesystem():
     shutil.rmtree(this.fs_dir)
 
 
 def create_file(filename):
-    filepath = os.path.join(this.fs_dir, filename)
+    filepath = get_filepath(filename)
 
     # If the file exists, skip creation
     if os.path.exists(filepath):
         return
 
     # Create the file, don't write anything yet
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
     with open(filepath, "w") as fp:
         pass
 
 
 def delete_file(filename):
-    filepath = os.path.join(this.fs_dir, filename)
-
-    # If the file doesn't exist, skip deletion
-    if not os.path.exists(filepath):
-        return
+    filepath = get_filepath(filename)
 
     # Delete the file
-    os.unlink(filepath)
+    with this.file_locks.lock(filename):
+        # If the file doesn't exist, skip deletion
+        if not os.path.exists(filepath):
+            return
+
+        os.unlink(filepath)
+        this.content_cache.invalidate(filename)
+    _sync_dir(os.path.dirname(filepath))
 
 
 def read_file(filename):
-    filepath = os.path.join(this.fs_dir, filename)
+    """
+    Returns the content as text. Raw uploads may have any bytes, so bytes that aren't utf-8 are read as U+FFFD.
+    """
+    filepath = get_filepath(filename)
 
-    # If the file doesn't exist, skip deletion
-    if not os.path.exists(filepath):
+    # If the file doesn't exist, skip reading
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
         return
 
-    # Create the file, don't write anything yet
-    with open(filepath, "r") as fp:
-        content = fp.read()
+    # Serve the content from the cache if the file didn't change since it was cached
+    content = this.content_cache.get(filename, stat)
+    if content is not None:
+        return content
+
+    # Read the file and cache it with the stat of the version that was read
+    with open(filepath, "rb") as fp:
+        stat = os.fstat(fp.fileno())
+        if file_codec.is_framed(fp):
+            data = b''.join(file_codec.iter_content(fp))
+            size = len(data)
+            content = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8', errors='replace').read()
+        else:
+            size = stat.st_size
+            content = io.TextIOWrapper(fp, encoding='utf-8', errors='replace').read()
+    metrics.file_bytes_read.inc(amount=size)
+    this.content_cache.put(filename, stat, content, size)
 
     return content
 
 
 def write_file(filename, content):
-    filepath = os.path.join(this.fs_dir, filename)
+    """
+    Returns the SHA-256 of the content if it's stored as a deduplicated blob, None otherwise
+    """
+    return _write_atomically(filename, [content.encode('utf-8')])
 
-    # If the file doesn't exist, skip deletion
+
+def _write_atomically(filename, chunks):
+    """
+    Writes a new version of the file into a temporary file, then renames it over the file.
+    Readers see either the old or the new content, never a truncated or half written file.
+    """
+    with this.file_locks.lock(filename):
+        return _write_atomically_locked(filename, chunks, this.dedup)
+
+
+def _write_atomically_locked(filename, chunks, dedup=False):
+    filepath = get_filepath(filename)
+
+    # If the file doesn't exist (or was deleted while waiting for the lock), skip writing
     if not os.path.exists(filepath):
+        return None
+
+    # Hash the content on its way to the disk
+    if dedup:
+        hasher = hashlib.sha256()
+        chunks = _hash_chunks(chunks, hasher)
+
+    dirpath = os.path.dirname(filepath)
+    temp_filepath = os.path.join(dirpath, '.blp-{}.tmp'.format(uuid.uuid4().hex))
+    digest = None
+    try:
+        with open(temp_filepath, "wb") as fp:
+            _write_content(fp, chunks)
+
+            # The data must be on disk before the rename, otherwise a crash might leave an empty file
+            if this.durability != DURABILITY_NONE:
+                fp.flush()
+                os.fsync(fp.fileno())
+
+        if dedup:
+            digest = hasher.hexdigest()
+            temp_filepath = _link_blob(digest, temp_filepath)
+
+        os.replace(temp_filepath, filepath)
+    except:
+        if os.path.exists(temp_filepath):
+            os.unlink(temp_filepath)
+        raise
+    finally:
+        # The cached content is outdated now
+        this.content_cache.invalidate(filename)
+
+    # Persist the rename
+    _sync_dir(dirpath)
+
+    return digest
+
+
+def _hash_chunks(chunks, hasher):
+    for chunk in chunks:
+        hasher.update(chunk)
+        yield chunk
+
+
+def _link_blob(digest, temp_filepath):
+    """
+    Links the new version of a file (in temp_filepath) with the blob of its content.
+    If the blob exists, the new version is replaced with a link to it, otherwise it becomes the blob.
+    Returns the path that should be renamed over the file.
+    """
+    blob_path = get_blob_path(digest)
+    linked_filepath = temp_filepath + '.link'
+    try:
+        os.link(blob_path, linked_filepath)
+        os.unlink(temp_filepath)
+        return linked_filepath
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    try:
+        os.link(temp_filepath, blob_path)
+        _sync_dir(os.path.dirname(blob_path))
+    except FileExistsError:
+        # Another writer stored the same content meanwhile, this version just stays unshared
+        pass
+
+    return temp_filepath
+
+
+def _unshare_locked(filepath):
+    """
+    A file that shares its storage with a blob must be copied before it's changed in place,
+    otherwise the change would apply to the blob and to every other file that is linked to it
+    """
+    try:
+        if os.stat(filepath).st_nlink <= 1:
+            return
+    except FileNotFoundError:
         return
 
-    # Create the file, don't write anything yet
-    with open(filepath, "w") as fp:
-        fp.write(content)
+    temp_filepath = os.path.join(os.path.dirname(filepath), '.blp-{}.tmp'.format(uuid.uuid4().hex))
+    try:
+        shutil.copyfile(filepath, temp_filepath)
+        os.replace(temp_filepath, filepath)
+    except:
+        if os.path.exists(temp_filepath):
+            os.unlink(temp_filepath)
+        raise
+
+
+def _write_content(fp, chunks):
+    """
+    Writes the whole content of a file. The content is compressed (framed) if it's at least compression_threshold long,
+    and also if it happens to start like a framed file, so that it's never mistaken for one.
+    """
+    # Buffer enough of the content in order to decide how to store it
+    chunks = iter(chunks)
+    head = bytearray()
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= max(this.compression_threshold or 0, len(file_codec.MAGIC)):
+            break
+
+    if this.compression and len(head) >= this.compression_threshold:
+        codec = this.compression
+    elif head.startswith(file_codec.MAGIC):
+        codec = file_codec.CODEC_STORE
+    else:
+        fp.write(head)
+        written = len(head)
+        for chunk in chunks:
+            fp.write(chunk)
+            written += len(chunk)
+        metrics.file_bytes_written.inc(amount=written)
+        return
+
+    fp.write(file_codec.MAGIC)
+    writer = file_codec.FrameWriter(fp, codec)
+    writer.write(head)
+    written = len(head)
+    for chunk in chunks:
+        writer.write(chunk)
+        written += len(chunk)
+    writer.close()
+    metrics.file_bytes_written.inc(amount=written)
+
+
+def _append_locked(filename, chunks):
+    """
+    Appends byte chunks to the file, while holding its lock.
+    Framed files get new frames at their end. Raw files are appended as is, unless they're shorter than
+    file_codec.MAGIC - those are rewritten, so that an append can't make them look like a framed file.
+    """
+    filepath = get_filepath(filename)
+    _unshare_locked(filepath)
+
+    # The file might have been deleted while waiting for the lock, don't create it again
+    try:
+        fp = open(filepath, "r+b")
+    except FileNotFoundError:
+        return
+
+    with fp:
+        framed = file_codec.is_framed(fp)
+        if not framed:
+            head = fp.read(len(file_codec.MAGIC))
+            if len(head) < len(file_codec.MAGIC):
+                fp.close()
+                _write_atomically_locked(filename, itertools.chain([head], chunks))
+                return
+
+        fp.seek(0, os.SEEK_END)
+        if framed:
+            # Small appends are stored as is, compressing them separately wouldn't save anything
+            chunks = iter(chunks)
+            first_chunk = next(chunks, b'')
+            large = this.compression and len(first_chunk) >= this.compression_threshold
+            writer = file_codec.FrameWriter(fp, this.compression if large else file_codec.CODEC_STORE)
+            writer.write(first_chunk)
+            written = len(first_chunk)
+            for chunk in chunks:
+                writer.write(chunk)
+                written += len(chunk)
+            writer.close()
+        else:
+            written = 0
+            for chunk in chunks:
+                fp.write(chunk)
+                written += len(chunk)
+        metrics.file_bytes_written.inc(amount=written)
+
+        if this.durability != DURABILITY_NONE:
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    # The cached content is outdated now
+    this.content_cache.invalidate(filename)
+
+
+def _sync_dir(dirpath):
+    if this.durability == DURABILITY_BATCH:
+        this.dir_syncer.sync(dirpath)
+    elif this.durability == DURABILITY_FULL:
+        _fsync_path(dirpath)
 
 
 def append_file(filename, content):
-    filepath = os.path.join(this.fs_dir, filename)
+    """
+    Concurrent appends to the same file are coalesced: the first appender that gets the file's lock
+    writes all the appends that are queued by then, in their order, with a single write.
+    """
+    filepath = get_filepath(filename)
 
     # If the file doesn't exist, skip deletion
     if not os.path.exists(filepath):
         return
 
-    # Create the file, don't write anything yet
-    with open(filepath, "a") as fp:
-        fp.write(content)
+    with this.file_locks.acquire(filename) as file_lock:
+        # Queue the append
+        with file_lock.pending_lock:
+            file_lock.pending_appends.append(content)
+            file_lock.last_ticket += 1
+            ticket = file_lock.last_ticket
+
+        with file_lock.lock:
+            # While waiting for the lock, another appender might have written this append as part of its group
+            if file_lock.written_ticket >= ticket:
+                for first_ticket, last_ticket, error in file_lock.failed_groups:
+                    if first_ticket <= ticket <= last_ticket:
+                        raise IOError("Append to {} failed: {}".format(filename, error))
+                return
+
+            # Take all the queued appends (in their order) and write them with a single write (group commit)
+            with file_lock.pending_lock:
+                group = file_lock.pending_appends
+                file_lock.pending_appends = []
+                first_ticket, last_ticket = file_lock.written_ticket + 1, file_lock.last_ticket
+
+            try:
+                _append_locked(filename, [''.join(group).encode('utf-8')])
+            except Exception as e:
+                file_lock.failed_groups.append((first_ticket, last_ticket, e))
+                raise
+            finally:
+                file_lock.written_ticket = last_ticket
+
+
+def stat_file(filename):
+    """
+    Returns the os.stat_result of the file or None if it doesn't exist
+    """
+    filepath = get_filepath(filename)
+
+    try:
+        return os.stat(filepath)
+    except FileNotFoundError:
+        return None
+
+
+def get_etag(stat):
+    """
+    An ETag derived from the file's modification time and size, which changes on every write or append
+    """
+    return '{:x}-{:x}'.format(stat.st_mtime_ns, stat.st_size)
+
+
+def get_size(fp):
+    """
+    The size of the content of an open file, which is smaller than its size on disk if it's compressed
+    """
+    if file_codec.is_framed(fp):
+        return file_codec.content_size(fp)
+
+    return os.fstat(fp.fileno()).st_size
+
+
+def get_content_size(filename):
+    """
+    The size of the file's content, or 0 if it doesn't exist
+    """
+    fp = open_file(filename)
+    if not fp:
+        return 0
+
+    with fp:
+        return get_size(fp)
+
+
+def is_compressed(fp):
+    return file_codec.is_framed(fp)
+
+
+def compression_info(filename):
+    """
+    Returns how the file is stored: its codecs, its size on disk, the size of its content and their ratio.
+    Returns None if the file doesn't exist.
+    """
+    fp = open_file(filename)
+    if not fp:
+        return None
+
+    with fp:
+        stored_bytes = os.fstat(fp.fileno()).st_size
+        codecs = set()
+        content_bytes = stored_bytes
+        if file_codec.is_framed(fp):
+            content_bytes = 0
+            for codec_id, content_length, stored_length in file_codec.iter_frames(fp):
+                codecs.add(file_codec.CODEC_NAMES.get(codec_id, str(codec_id)))
+                content_bytes += content_length
+
+    return {
+        'compressed': bool(codecs),
+        'codecs': sorted(codecs),
+        'stored_bytes': stored_bytes,
+        'content_bytes': content_bytes,
+        'ratio': content_bytes / stored_bytes if stored_bytes else 1.0
+    }
+
+
+def read_file_range(filename, start, stop):
+    """
+    Reads the bytes [start, stop) of the file by seeking to start, without reading what's before it
+    """
+    return b''.join(iter_file(filename, start, stop))
+
+
+def open_file(filename):
+    """
+    Opens the file for reading bytes, or returns None if it doesn't exist.
+    The caller is responsible for closing it.
+    """
+    try:
+        return open(get_filepath(filename), "rb")
+    except FileNotFoundError:
+        return None
+
+
+def iter_file(filename, start=0, stop=None, chunk_size=CHUNK_SIZE):
+    """
+    Generator that yields the content of the file as byte chunks, so that only one chunk is held in memory at a time.
+    If start / stop are given, only the bytes [start, stop) are yielded.
+    """
+    fp = open_file(filename)
+
+    # If the file doesn't exist, there's nothing to yield
+    if not fp:
+        return
+
+    with fp:
+        for chunk in iter_fp(fp, start, stop, chunk_size):
+            yield chunk
+
+
+def iter_fp(fp, start=0, stop=None, chunk_size=CHUNK_SIZE):
+    """
+    Like iter_file, for a file that is already open.
+    Compressed files are decompressed one frame at a time.
+    """
+    if file_codec.is_framed(fp):
+        for chunk in file_codec.iter_content(fp, start, stop):
+            metrics.file_bytes_read.inc(amount=len(chunk))
+            yield chunk
+        return
+
+    fp.seek(start)
+
+    remaining = stop - start if stop is not None else None
+    while remaining is None or remaining > 0:
+        chunk = fp.read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+
+        metrics.file_bytes_read.inc(amount=len(chunk))
+        yield chunk
+
+
+def write_file_stream(filename, chunks, append=False):
+    """
+    Writes (or appends) an iterable of byte chunks to the file, one chunk at a time.
+    A write (not an append) returns the SHA-256 of the content if it's stored as a deduplicated blob.
+    """
+    if not append:
+        return _write_atomically(filename, chunks)
+
+    with this.file_locks.lock(filename):
+        _append_locked(filename, chunks)
+
+
+def write_file_at(filename, offset, chunks):
+    """
+    Writes an iterable of byte chunks into the file in place, starting at offset (pwrite),
+    so the cost depends on the size of the change and not on the size of the file.
+    The offset may be at most the file's size (writing at the size extends the file).
+    Unlike write_file, a crash in the middle might leave the change partially written.
+    Compressed files can't be changed in place, so they're rewritten (streamed, with only the change in memory).
+    Returns the number of bytes written, or None if the file doesn't exist.
+    """
+    filepath = get_filepath(filename)
+
+    with this.file_locks.lock(filename):
+        _unshare_locked(filepath)
+
+        # If the file doesn't exist, skip writing
+        try:
+            fp = open(filepath, "r+b")
+        except FileNotFoundError:
+            return None
+
+        with fp:
+            # Don't leave holes in the file
+            if offset < 0 or offset > get_size(fp):
+                raise ValueError("Offset {} is out of the file's range".format(offset))
+
+            if file_codec.is_framed(fp):
+                change = b''.join(chunks)
+                content = itertools.chain(iter_fp(fp, 0, offset), [change], iter_fp(fp, offset + len(change)))
+                _write_atomically_locked(filename, content)
+                return len(change)
+
+            position = offset
+            try:
+                for chunk in chunks:
+                    view = memoryview(chunk)
+                    while view:
+                        written = os.pwrite(fp.fileno(), view, position)
+                        position += written
+                        view = view[written:]
+
+                if this.durability != DURABILITY_NONE:
+                    os.fsync(fp.fileno())
+            finally:
+                metrics.file_bytes_written.inc(amount=position - offset)
+                # The cached content is outdated now
+                this.content_cache.invalidate(filename)
+
+            # The change might have made the file look like a framed file, store it framed in that case
+            if offset < len(file_codec.MAGIC) and file_codec.is_framed(fp):
+                fp.seek(0)
+                _write_atomically_locked(filename, iter(lambda: fp.read(CHUNK_SIZE), b''))
+
+        return position - offset
@@ -1,12 +1,26 @@
-from flask import Blueprint, request, jsonify
+import os
+import json
+import numpy as np
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from werkzeug.wsgi import wrap_file
 from werkzeug.exceptions import Unauthorized
+from sqlalchemy.exc import IntegrityError
 from api_utils import ApiErorrCode, api_ok, api_error
 import db_manager
 from orm.user import User
 from orm.file import File
+from orm.level import BlpLevel, compartments_from_names, compartment_names
 import auth
+import password_hasher
 import file_manager
 import blp_rules
+import access_cache
+import blob_store
+import metrics
+import profiler
+import audit_log
+import user_import
+import change_feed
 
 bp_endpoints = Blueprint('gw_endpoints', __name__)
 
@@ -16,21 +30,54 @@ bp_endpoints = Blueprint('gw_endpoints', __name__)
 def users_create():
     data = request.get_json()
 
-    with db_manager.session_scope() as session:
-        # Verify that a user with the same email doesn't exist
-        users = session.query(User).filter(User.email == data['email']).all()
-        if users:
-            return api_error(api_result_code=ApiErorrCode.USER_EXISTS, error_message="User {} already exists".format(data['email']))
+    try:
+        compartments = compartments_from_names(data.get('compartments'))
+    except KeyError as e:
+        return api_error(error_message="Unknown compartment {}".format(e.args[0]))
 
+    # Hash the password before opening a session, since it takes a while
+    try:
+        hashed_pass, salt, kdf = password_hasher.hash_password(data['password'])
+    except password_hasher.PoolBusy:
+        return busy_error()
+
+    with db_manager.session_scope() as session:
         # Create the user
-        hashed_pass, salt = auth.pass_to_hash(data['password'])
-        user = User(name=data['name'], email=data.get('email', None), password=hashed_pass, salt=salt, level=data['level'])
+        user = User(name=data['name'], email=data.get('email', None), password=hashed_pass, salt=salt, kdf=kdf, level=data['level'], compartments=compartments)
         session.add(user)
-        session.commit()
+
+        # A user with the same email is rejected by the unique index on the email column
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            return api_error(api_result_code=ApiErorrCode.USER_EXISTS, error_message="User {} already exists".format(data['email']))
 
         return jsonify(user.to_dict())
 
 
+@bp_endpoints.route('/users/import', methods=['POST'])
+@auth.requires_auth(admin_only=True)
+def users_import():
+    """
+    Bulk import of users from the request body (see user_import), which is consumed while the report is streamed back.
+    Query params:
+        format - 'csv' (default) or 'jsonl'
+    The report is a JSON line per row, in the input's order.
+    """
+    input_format = request.args.get('format', user_import.FORMAT_CSV)
+    if input_format not in (user_import.FORMAT_CSV, user_import.FORMAT_JSONL):
+        return api_error(error_message="Unknown format {}".format(input_format))
+
+    def generate():
+        # Line by line, a line never ends in the middle of a utf-8 character
+        text_stream = (line.decode('utf-8', errors='replace') for line in request.stream)
+        for report in user_import.import_users(user_import.iter_rows(text_stream, input_format)):
+            yield json.dumps(report) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 @bp_endpoints.route('/users/<user_id>', methods=['DELETE'])
 @auth.requires_auth(admin_only=True)
 def users_delete(user_id):
@@ -40,6 +87,9 @@ def users_delete(user_id):
             return api_error()
         else:
             session.delete(user)
+
+            # The user no longer exists, reject the access tokens that were already issued to it (in all the workers)
+            auth.revoke_user(session, user.id)
             session.commit()
 
             return api_ok()
@@ -61,11 +111,28 @@ def login():
             return login_error()
 
         # Validate the password
-        hashed_password, _ = auth.pass_to_hash(data['password'], user.salt)
-        if hashed_password == user.password:
-            return jsonify({'id': user.id})
-        else:
-            return login_error()
+        try:
+            if not password_hasher.verify_password(data['password'], user.password, user.salt, user.kdf):
+                return login_error()
+        except password_hasher.PoolBusy:
+            return busy_error()
+
+        # Rehash the password with the current KDF, now that it's known. Left for the next login if the pool is busy.
+        if password_hasher.needs_upgrade(user.kdf):
+            try:
+                user.password, user.salt, user.kdf = password_hasher.hash_password(data['password'])
+                session.commit()
+            except password_hasher.PoolBusy:
+                pass
+
+        return jsonify({'id': user.id, 'token': auth.create_access_token(user.id, user.level, user.compartments)})
+
+
+def busy_error(error_message="Too many concurrent password hashings, try again later"):
+    response = api_error(http_code=503, api_result_code=ApiErorrCode.BUSY, error_message=error_message)
+    response.headers['Retry-After'] = '1'
+
+    return response
 
 
 @bp_endpoints.route('/files', methods=['POST'])
@@ -75,29 +142,73 @@ def files_create():
     user_id = auth.get_current_user_id()
 
     with db_manager.session_scope() as session:
-        # Get user from DB
-        user = session.query(User).get(user_id)
-
-        # Verify that user exists
-        if not user:
-            return api_error(http_code=Unauthorized.code, api_result_code=ApiErorrCode.UNAUTHORIZED)
+        # Create the file in DB with the same label (level and compartments) of the owner user (taken from the access token)
+        file = File(filename=data['filename'], level=auth.get_current_user_level(), compartments=auth.get_current_user_compartments(), owner_id=user_id)
+        session.add(file)
 
-        # Verify that file doesn't exist yet
-        file = session.query(File).filter(File.filename == data['filename']).all()
-        if file:
+        # An existing file with the same name is rejected by the unique index on the filename column
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
             return api_error(api_result_code=ApiErorrCode.FILE_ALREADY_EXISTS)
 
-        # Create the file in DB with the same level of the owner user
-        file = File(filename=data['filename'], level=user.level, owner=user)
-        session.add(file)
-        session.commit()
+        access_cache.invalidate_file(file.filename)
 
         # Create the file on the filesystem
         file_manager.create_file(file.filename)
+        publish_change(change_feed.EVENT_CREATE, file)
 
         return jsonify(file.to_dict())
 
 
+@bp_endpoints.route('/files', methods=['GET'])
+@auth.requires_auth()
+def files_list():
+    """
+    Lists the files that the user may read, ordered by id.
+    Query params:
+        after - cursor, only files with a bigger id are returned (the next_cursor of the previous page)
+        limit - page size, up to MAX_LIST_PAGE_SIZE
+        owner_id, level - optional filters
+        compartments - optional filter, comma separated compartments that the files must have
+    """
+    user_level = auth.get_current_user_level()
+    user_compartments = auth.get_current_user_compartments()
+
+    try:
+        after = request.args.get('after', 0, type=int)
+        limit = max(1, min(request.args.get('limit', DEFAULT_LIST_PAGE_SIZE, type=int), MAX_LIST_PAGE_SIZE))
+        owner_id = request.args.get('owner_id', None, type=int)
+        level = BlpLevel[request.args['level']] if 'level' in request.args else None
+        compartments = compartments_from_names(request.args['compartments'].split(',')) if request.args.get('compartments') else None
+    except KeyError as e:
+        return api_error(error_message="Unknown level or compartment {}".format(e.args[0]))
+
+    with db_manager.session_scope() as session:
+        # Enforce BLP no read up in the WHERE clause, and page by id (keyset pagination)
+        query = session.query(File).filter(*blp_rules.readable_files_criteria(user_level, user_compartments)).filter(File.id > after)
+        if owner_id is not None:
+            query = query.filter(File.owner_id == owner_id)
+        if level is not None:
+            query = query.filter(File.level == level)
+        if compartments is not None:
+            query = query.filter(File.compartments.op('&')(int(compartments)) == int(compartments))
+
+        # Fetch one extra row in order to know whether there's a next page
+        files = query.order_by(File.id).limit(limit + 1).all()
+        next_cursor = None
+        if len(files) > limit:
+            files = files[:limit]
+            next_cursor = files[-1].id
+
+        return jsonify({'files': [file.to_dict() for file in files], 'next_cursor': next_cursor})
+
+
+DEFAULT_LIST_PAGE_SIZE = 100
+MAX_LIST_PAGE_SIZE = 1000
+
+
 @bp_endpoints.route('/files', methods=['DELETE'])
 @auth.requires_auth()
 def files_delete():
@@ -114,12 +225,18 @@ def files_delete():
         if file.owner_id != user_id:
             return api_error(http_code=Unauthorized.code, api_result_code=ApiErorrCode.UNAUTHORIZED, error_message="The file can be deleted only by its owner")
 
-        # Delete the file entry from DB
+        # The deleted row can't be read after the commit
+        level, compartments = file.level, file.compartments
+
+        # Delete the file entry from DB, with its reference to its deduplicated content
+        blob_store.set_file_blob(session, file, None)
         session.delete(file)
         session.commit()
+        access_cache.invalidate_file(data['filename'])
 
         # Delete the file on the filesystem
         file_manager.delete_file(data['filename'])
+        change_feed.publish(change_feed.EVENT_DELETE, data['filename'], level, compartments, user_id)
 
         return api_ok()
 
@@ -137,51 +254,522 @@ def files_append():
 
 
 def write_or_append(write_func):
-    user_id = auth.get_current_user_id()
     data = request.get_json()
 
-    with db_manager.session_scope() as session:
-        # Verify that file exists
-        file = session.query(File).filter(File.filename == data['filename']).one_or_none()
-        if not file:
-            return api_error(api_result_code=ApiErorrCode.FILE_NOT_EXISTS)
-
-        # Get the user from DB
-        user = session.query(User).get(user_id)
-        if not user:
-            return api_error(http_code=Unauthorized.code, api_result_code=ApiErorrCode.UNAUTHORIZED)
-
-        # Enforce BLP no write down
-        if not blp_rules.enforce_blp_write(user.level, file.level):
-            return api_error(http_code=Unauthorized.code, api_result_code=ApiErorrCode.UNAUTHORIZED)
+    # Enforce BLP no write down
+    file, error = authorize_file_access(data['filename'], blp_rules.enforce_blp_write)
+    if error:
+        return error
 
-        # Write to the file
-        write_func(file.filename, data['content'])
+    # Write to the file
+    digest = write_func(file.filename, data['content'])
+    update_file_blob(file.filename, digest)
+    publish_change(change_feed.EVENT_WRITE if write_func is file_manager.write_file else change_feed.EVENT_APPEND, file)
 
-        return api_ok()
+    return api_ok()
 
 
 @bp_endpoints.route('/files/<filename>', methods=['GET'])
 @auth.requires_auth()
 def files_read(filename):
-    user_id = auth.get_current_user_id()
+    """
+    Supports conditional GET (If-None-Match). Byte ranges are served only by the raw content endpoint,
+    since they can't describe a JSON body.
+    """
+    # Enforce BLP no read up
+    file, error = authorize_file_access(filename, blp_rules.enforce_blp_read)
+    if error:
+        return error
+
+    def make_body(byte_range):
+        return jsonify({'content': file_manager.read_file(file.filename)})
+
+    return conditional_file_response(file.filename, make_body, byte_ranges=False, etag_suffix=JSON_ETAG_SUFFIX)
+
+
+# Distinguishes the ETag of the JSON representation of a file from the ETag of its raw content
+JSON_ETAG_SUFFIX = '-json'
+
+
+@bp_endpoints.route('/files/<filename>/content', methods=['GET'])
+@auth.requires_auth()
+def files_download(filename):
+    """
+    Sends the raw bytes of the file without loading it into memory.
+    The whole file is sent through the WSGI server's file wrapper (sendfile under gunicorn), a byte range is streamed in chunks.
+    Supports conditional GET (If-None-Match) and a single byte range (Range / If-Range).
+    """
+    # Enforce BLP no read up (before the file is even opened)
+    file, error = authorize_file_access(filename, blp_rules.enforce_blp_read)
+    if error:
+        return error
+
+    # If the file doesn't exist on the filesystem, send an empty body
+    fp = file_manager.open_file(file.filename)
+    if not fp:
+        return Response(b'', mimetype='application/octet-stream')
+
+    # The headers are based on the version of the file that was opened, even if it's replaced meanwhile
+    stat = os.fstat(fp.fileno())
+    size = file_manager.get_size(fp)
+
+    def make_body(byte_range):
+        if byte_range:
+            start, stop = byte_range
+            response = Response(file_manager.iter_fp(fp, start, stop), mimetype='application/octet-stream')
+        elif file_manager.is_compressed(fp):
+            # A compressed file has to be decompressed on the way out
+            response = Response(file_manager.iter_fp(fp), mimetype='application/octet-stream')
+        else:
+            # The file wrapper bypasses iter_fp, so its bytes are counted here
+            metrics.file_bytes_read.inc(amount=size)
+            response = Response(wrap_file(request.environ, fp), mimetype='application/octet-stream', direct_passthrough=True)
+        response.content_length = stop - start if byte_range else size
+
+        return response
 
+    response = conditional_file_response(file.filename, make_body, stat, size)
+    response.call_on_close(fp.close)
+
+    return response
+
+
+@bp_endpoints.route('/files/<filename>/storage', methods=['GET'])
+@auth.requires_auth()
+def files_storage(filename):
+    """
+    How the file is stored on disk: its codecs, its stored and content sizes and its compression ratio
+    """
+    # Enforce BLP no read up
+    file, error = authorize_file_access(filename, blp_rules.enforce_blp_read)
+    if error:
+        return error
+
+    info = file_manager.compression_info(file.filename)
+    if not info:
+        return api_error(api_result_code=ApiErorrCode.FILE_NOT_EXISTS)
+
+    return jsonify(info)
+
+
+def conditional_file_response(filename, make_body, stat=None, size=None, byte_ranges=True, etag_suffix=''):
+    """
+    Answers 304 if the client's ETag is still current, 416 for an unsatisfiable single range,
+    otherwise calls make_body with the requested (start, stop) byte range or None for the whole file.
+    stat and size (of the content, which differs from the stat's size for compressed files) are taken from the file if not given.
+    Without byte_ranges, Range headers are ignored. etag_suffix tells apart the ETags of other representations of the file.
+    """
+    if not stat:
+        stat = file_manager.stat_file(filename)
+    if not stat:
+        return make_body(None)
+    etag = file_manager.get_etag(stat) + etag_suffix
+
+    # The client already has the current version of the file
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    # A single Range is served only if there's no If-Range or the If-Range ETag still matches. Since no Last-Modified
+    # is sent, an If-Range date can't match. Multiple ranges aren't supported, so the whole file is served for them.
+    byte_range = None
+    if_range = request.if_range
+    range_is_current = if_range.etag == etag if if_range.etag or if_range.date else True
+    if byte_ranges and request.range and len(request.range.ranges) == 1 and range_is_current:
+        if size is None:
+            size = file_manager.get_content_size(filename)
+        byte_range = request.range.range_for_length(size)
+        if not byte_range:
+            response = Response(status=416)
+            response.headers['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+
+    response = make_body(byte_range)
+    if byte_range:
+        response.status_code = 206
+        response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(byte_range[0], byte_range[1] - 1, size)
+    response.set_etag(etag)
+    if byte_ranges:
+        response.headers['Accept-Ranges'] = 'bytes'
+
+    return response
+
+
+@bp_endpoints.route('/files/<filename>/content', methods=['PUT'])
+@auth.requires_auth()
+def files_upload(filename):
+    """
+    Overwrites the file with the raw request body, which is consumed in chunks.
+    With an offset query param, only the bytes at [offset, offset + body length) are overwritten in place.
+    """
+    if 'offset' in request.args:
+        return write_at_stream(filename)
+
+    return write_or_append_stream(filename, append=False)
+
+
+@bp_endpoints.route('/files/<filename>/content', methods=['PATCH'])
+@auth.requires_auth()
+def files_upload_append(filename):
+    """
+    Appends the raw request body to the file, which is consumed in chunks
+    """
+    return write_or_append_stream(filename, append=True)
+
+
+def write_or_append_stream(filename, append):
+    # Enforce BLP no write down
+    file, error = authorize_file_access(filename, blp_rules.enforce_blp_write)
+    if error:
+        return error
+
+    # Stream the request body into the file
+    digest = file_manager.write_file_stream(file.filename, iter_request_body(), append=append)
+    update_file_blob(file.filename, digest)
+    publish_change(change_feed.EVENT_APPEND if append else change_feed.EVENT_WRITE, file)
+
+    return api_ok()
+
+
+def write_at_stream(filename):
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return api_error(api_result_code=ApiErorrCode.INVALID_OFFSET, error_message="Offset must be an integer")
+
+    # Enforce BLP no write down
+    file, error = authorize_file_access(filename, blp_rules.enforce_blp_write)
+    if error:
+        return error
+
+    # Stream the request body into the file at the offset
+    try:
+        file_manager.write_file_at(file.filename, offset, iter_request_body())
+    except ValueError as e:
+        return api_error(api_result_code=ApiErorrCode.INVALID_OFFSET, error_message=str(e))
+    update_file_blob(file.filename, None)
+    publish_change(change_feed.EVENT_WRITE, file)
+
+    return api_ok()
+
+
+def update_file_blob(filename, digest):
+    """
+    After a file was changed, points it at the deduplicated blob of its new content (digest),
+    or releases its blob if the change wasn't a whole-file write (digest is None)
+    """
+    if file_manager.dedup:
+        blob_store.update_file_blob(filename, digest)
+
+
+def publish_change(event_type, file):
+    """
+    Publishes a change of the file by the current user to the change feed
+    """
+    change_feed.publish(event_type, file.filename, file.level, file.compartments, auth.get_current_user_id())
+
+
+def iter_request_body(chunk_size=file_manager.CHUNK_SIZE):
+    while True:
+        chunk = request.stream.read(chunk_size)
+        if not chunk:
+            break
+
+        yield chunk
+
+
+def audit_busy_error():
+    return busy_error("The audit log is behind, try again later")
+
+
+def authorize_file_access(filename, blp_rule):
+    """
+    Enforces the given BLP rule for the current user on the file.
+    Returns a (file, error response) tuple, where exactly one of them is None.
+    """
     with db_manager.session_scope() as session:
-        # Verify that file exists
-        file = session.query(File).filter(File.filename == filename).one_or_none()
+        # Verify that file exists (the DB is queried only on a cache miss)
+        file = access_cache.get_file(session, filename)
         if not file:
-            return api_error(api_result_code=ApiErorrCode.FILE_NOT_EXISTS)
+            return None, api_error(api_result_code=ApiErorrCode.FILE_NOT_EXISTS)
 
-        # Get the user from DB
-        user = session.query(User).get(user_id)
-        if not user:
-            return api_error(http_code=Unauthorized.code, api_result_code=ApiErorrCode.UNAUTHORIZED)
+    # Enforce the BLP rule with the user's label from the access token, and audit the decision
+    user_level = auth.get_current_user_level()
+    user_compartments = auth.get_current_user_compartments()
+    allowed = blp_rule(user_level, file.level, user_compartments, file.compartments)
+    try:
+        audit_log.record(auth.get_current_user_id(), user_level, user_compartments, blp_rule.__name__, request.endpoint, file.filename, file.level, file.compartments, allowed)
+    except audit_log.AuditLogFull:
+        return None, audit_busy_error()
+    if not allowed:
+        return None, api_error(http_code=Unauthorized.code, api_result_code=ApiErorrCode.UNAUTHORIZED)
+
+    return file, None
+
+
+@bp_endpoints.route('/files/batch', methods=['POST'])
+@auth.requires_auth()
+def files_batch():
+    """
+    Runs a list of create / write / append / read / delete operations in a single DB session and transaction.
+    Every operation is a dict with 'op', 'filename' and, for write / append, 'content'.
+    The BLP rules are enforced per operation and the result of every operation is returned in the same order.
+    The filesystem changes are undone if the transaction fails, so the files stay consistent with the DB.
+    """
+    operations = request.get_json()['operations']
+    user_id = auth.get_current_user_id()
+    user_level = auth.get_current_user_level()
+    user_compartments = auth.get_current_user_compartments()
+
+    with db_manager.session_scope() as session:
+        # Load all the referenced files with IN queries, chunked below sqlite's limit of bound parameters
+        filenames = list({operation.get('filename') for operation in operations})
+        files = {}
+        for i in range(0, len(filenames), BATCH_IN_QUERY_SIZE):
+            for file in session.query(File).filter(File.filename.in_(filenames[i:i + BATCH_IN_QUERY_SIZE])):
+                files[file.filename] = file
+
+        changes = []
+        undo_log = []
+        try:
+            results = [run_batch_operation(session, user_id, user_level, user_compartments, files, operation, changes, undo_log) for operation in operations]
+
+            # Commit all the DB changes at once
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            undo_batch(undo_log)
+            return api_error(api_result_code=ApiErorrCode.FILE_ALREADY_EXISTS)
+        except audit_log.AuditLogFull:
+            session.rollback()
+            undo_batch(undo_log)
+            return audit_busy_error()
+        except:
+            session.rollback()
+            undo_batch(undo_log)
+            raise
+
+        for undo in undo_log:
+            undo.discard()
+
+        # Created and deleted files change what the cache should answer
+        for operation in operations:
+            if operation.get('op') in ('create', 'delete'):
+                access_cache.invalidate_file(operation.get('filename'))
+
+        # Only the committed changes are published
+        for event_type, filename, level, compartments in changes:
+            change_feed.publish(event_type, filename, level, compartments, user_id)
+
+        return jsonify({'results': results})
+
+
+# Max number of filenames in a single IN query of a batch
+BATCH_IN_QUERY_SIZE = 500
+
+
+def undo_batch(undo_log):
+    """
+    Reverts the filesystem changes of a batch whose transaction failed, the latest first
+    """
+    for undo in reversed(undo_log):
+        undo.undo()
+
+
+def run_batch_operation(session, user_id, user_level, user_compartments, files, operation, changes, undo_log):
+    """
+    Runs a single operation of a batch.
+    files maps filenames to their File rows (None for files that were deleted in this batch) and is kept up to date.
+    A (change feed event type, filename, level, compartments) tuple is appended to changes for every file that changed.
+    Filesystem changes are applied right away, so that later operations of the same batch can see them,
+    and a file_manager.FileUndo of each of them is appended to undo_log.
+    """
+    def batch_error(api_result_code, error_message=None):
+        return {'api_result_code': api_result_code.name, 'message': error_message}
+
+    op = operation.get('op')
+    filename = operation.get('filename')
+    file = files.get(filename)
+
+    if op == 'create':
+        # Verify that file doesn't exist yet
+        if file:
+            return batch_error(ApiErorrCode.FILE_ALREADY_EXISTS)
+
+        # Create the file in DB with the same label of the owner user
+        file = File(filename=filename, level=user_level, compartments=user_compartments, owner_id=user_id)
+        session.add(file)
+        files[filename] = file
 
-        # Enforce BLP no write down
-        if not blp_rules.enforce_blp_read(user.level, file.level):
-            return api_error(http_code=Unauthorized.code, api_result_code=ApiErorrCode.UNAUTHORIZED)
+        # Create the file on the filesystem
+        undo = file_manager.FileUndo(filename)
+        undo_log.append(undo)
+        file_manager.create_file(filename)
+        undo.changed()
+        changes.append((change_feed.EVENT_CREATE, filename, user_level, user_compartments))
+
+        return {'api_result_code': None, 'file': {
+            'filename': filename,
+            'level': user_level.name,
+            'compartments': compartment_names(user_compartments),
+            'owner_id': user_id
+        }}
+
+    if op not in ('write', 'append', 'read', 'delete'):
+        return batch_error(ApiErorrCode.UNKNOWN_ERROR, "Unknown operation {}".format(op))
+    if op in ('write', 'append') and not isinstance(operation.get('content'), str):
+        return batch_error(ApiErorrCode.UNKNOWN_ERROR, "Missing content")
+
+    # Verify that file exists
+    if not file:
+        return batch_error(ApiErorrCode.FILE_NOT_EXISTS)
+
+    if op == 'read':
+        # Enforce BLP no read up
+        allowed = blp_rules.enforce_blp_read(user_level, file.level, user_compartments, file.compartments)
+        audit_log.record(user_id, user_level, user_compartments, 'enforce_blp_read', 'batch:read', filename, file.level, file.compartments, allowed)
+        if not allowed:
+            return batch_error(ApiErorrCode.UNAUTHORIZED)
+
+        return {'api_result_code': None, 'content': file_manager.read_file(filename)}
+
+    if op == 'delete':
+        # Verify that the user who tries to delete the file is the owner of the file
+        if file.owner_id != user_id:
+            return batch_error(ApiErorrCode.UNAUTHORIZED, "The file can be deleted only by its owner")
+
+        # A file that was created in this batch was never inserted, otherwise flush the deletion right away
+        # so that the filename can be created again later in the batch
+        if file in session.new:
+            session.expunge(file)
+        else:
+            blob_store.set_file_blob(session, file, None)
+            session.delete(file)
+            session.flush()
+        files[filename] = None
+        undo = file_manager.FileUndo(filename)
+        undo_log.append(undo)
+        file_manager.delete_file(filename)
+        undo.changed()
+        changes.append((change_feed.EVENT_DELETE, filename, file.level, file.compartments))
+
+        return {'api_result_code': None}
+
+    # Enforce BLP no write down
+    allowed = blp_rules.enforce_blp_write(user_level, file.level, user_compartments, file.compartments)
+    audit_log.record(user_id, user_level, user_compartments, 'enforce_blp_write', 'batch:' + op, filename, file.level, file.compartments, allowed)
+    if not allowed:
+        return batch_error(ApiErorrCode.UNAUTHORIZED)
+
+    # Write to the file
+    write_func = file_manager.write_file if op == 'write' else file_manager.append_file
+    undo = file_manager.FileUndo(filename, append=(op == 'append'))
+    undo_log.append(undo)
+    digest = write_func(filename, operation['content'])
+    undo.changed()
+    if file_manager.dedup:
+        blob_store.set_file_blob(session, file, digest)
+    changes.append((change_feed.EVENT_WRITE if op == 'write' else change_feed.EVENT_APPEND, filename, file.level, file.compartments))
+
+    return {'api_result_code': None}
+
+
+@bp_endpoints.route('/changes', methods=['GET'])
+@auth.requires_auth(allow_admin=True)
+def changes_stream():
+    """
+    Server-sent events of the changes to the files that the user may read (see change_feed).
+    A client resumes after the event whose id is in the Last-Event-ID header (or the last_event_id query param).
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    subscriber = change_feed.subscribe(auth.get_current_user_level(), auth.get_current_user_compartments(), last_event_id)
+
+    response = Response(change_feed.iter_stream(subscriber), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Don't let a reverse proxy buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    # The generator's cleanup doesn't run if it's never started
+    response.call_on_close(lambda: change_feed.unsubscribe(subscriber))
+
+    return response
+
+
+@bp_endpoints.route('/admin/access-cache', methods=['GET'])
+@auth.requires_auth(admin_only=True)
+def admin_access_cache():
+    return jsonify(access_cache.stats())
 
-        # Read from the file
-        content = file_manager.read_file(file.filename)
 
-        return jsonify({'content': content})
+@bp_endpoints.route('/admin/content-cache', methods=['GET'])
+@auth.requires_auth(admin_only=True)
+def admin_content_cache():
+    return jsonify(file_manager.content_cache.stats())
+
+
+@bp_endpoints.route('/admin/access-matrix', methods=['GET'])
+@auth.requires_auth(admin_only=True)
+def admin_access_matrix():
+    """
+    Which files every user may read and write, streamed as a JSON line per user.
+    Query params:
+        mode - 'counts' (default) for the number of readable / writable files, 'matrix' for their ids
+    """
+    mode = request.args.get('mode', 'counts')
+    if mode not in ('counts', 'matrix'):
+        return api_error(error_message="Unknown mode {}".format(mode))
+
+    # Only the labels are loaded, as arrays for the bulk evaluation
+    with db_manager.session_scope() as session:
+        users = session.query(User.id, User.level, User.compartments).order_by(User.id).all()
+        files = session.query(File.id, File.level, File.compartments).order_by(File.id).all()
+    user_ids = [user_id for user_id, level, compartments in users]
+    user_levels = [level.value for user_id, level, compartments in users]
+    user_compartments = [int(compartments) for user_id, level, compartments in users]
+    file_ids = np.array([file_id for file_id, level, compartments in files], dtype=np.int64)
+    file_levels = [level.value for file_id, level, compartments in files]
+    file_compartments = [int(compartments) for file_id, level, compartments in files]
+
+    def generate():
+        for start, read, write in blp_rules.iter_access_matrices(user_levels, file_levels, user_compartments, file_compartments):
+            lines = []
+            for i in range(len(read)):
+                if mode == 'counts':
+                    result = {'user_id': user_ids[start + i], 'readable': int(read[i].sum()), 'writable': int(write[i].sum())}
+                else:
+                    result = {'user_id': user_ids[start + i], 'read': file_ids[read[i]].tolist(), 'write': file_ids[write[i]].tolist()}
+                lines.append(json.dumps(result) + '\n')
+
+            yield ''.join(lines)
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@bp_endpoints.route('/admin/profiles', methods=['GET'])
+@auth.requires_auth(admin_only=True)
+def admin_profiles():
+    """
+    Summaries of the recently profiled requests (see profiler), the newest first
+    """
+    return jsonify(profiler.list_profiles())
+
+
+@bp_endpoints.route('/admin/profiles/<profile_id>', methods=['GET'])
+@auth.requires_auth(admin_only=True)
+def admin_profile(profile_id):
+    """
+    The cProfile stats and the SQL trace of a profiled request
+    """
+    profile = profiler.get_profile(profile_id)
+    if not profile:
+        return api_error(http_code=404, error_message="Profile {} not found".format(profile_id))
+
+    return jsonify(profile)
+
+
+@bp_endpoints.route('/metrics', methods=['GET'])
+def metrics_scrape():
+    """
+    The metrics of this process in the Prometheus text format.
+    Not authenticated, like any scrape target - it contains only route templates and counts, never filenames or users.
+    """
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
@@ -1,13 +1,21 @@
 import db_manager
+import access_cache
+import auth
+import migrations
 import file_manager
+import metrics
+import profiler
+import change_feed
 from orm import Base
 from flask import Flask
 from gw_endpoints import bp_endpoints
 
 
-def create_db(db_filename=None):
-    db_manager.init(db_filename)
+def create_db(db_filename=None, engine_profile=None):
+    db_manager.init(db_filename, engine_profile)
     Base.metadata.create_all(db_manager.engine)
+    migrations.upgrade(db_manager.engine)
+    access_cache.init()
 
 
 def init_filemanager(purge):
@@ -18,8 +26,13 @@ def purge_filesystem():
     file_manager.purge_filesystem()
 
 
-def start_flask():
+def start_flask(secret_key=None):
+    auth.init(secret_key)
+
     app = Flask(__name__)
     app.register_blueprint(bp_endpoints)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    change_feed.init()
 
     return app
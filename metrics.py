@@ -0,0 +1,190 @@
+"""
+Process-wide counters and histograms, exposed in the Prometheus text format.
+Every update takes a single short lock, so the metrics are cheap enough to be always on.
+Under gunicorn every worker process has its own metrics.
+"""
+import sys
+import time
+import bisect
+import threading
+
+
+this = sys.modules[__name__]
+this.registry = []
+# Statement count and time of the request that is handled by the current thread
+this.request_state = threading.local()
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the SQL statements per request histogram buckets
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return repr(value)
+
+
+class Counter(object):
+    """
+    A monotonically increasing value per combination of label values
+    """
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+        this.registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.append('{}{} {}'.format(self.name, _format_labels(self.label_names, label_values), _format_value(value)))
+
+        return lines
+
+
+class Histogram(object):
+    """
+    Counts observations in cumulative buckets, plus their sum and count, per combination of label values
+    """
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # Maps label values to [bucket counts (not cumulative), sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+        this.registry.append(self)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def get_count(self, *label_values):
+        with self._lock:
+            entry = self._values.get(label_values)
+            return entry[2] if entry else 0
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            values = sorted((label_values, (list(entry[0]), entry[1], entry[2])) for label_values, entry in self._values.items())
+        for label_values, (bucket_counts, total, count) in values:
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names, label_values, [('le', _format_value(float(upper_bound)))])
+                lines.append('{}_bucket{} {}'.format(self.name, labels, cumulative))
+            labels = _format_labels(self.label_names, label_values)
+            lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, labels, count))
+
+        return lines
+
+
+http_request_duration = Histogram(
+    'blp_http_request_duration_seconds', "Latency of the HTTP requests", ('route', 'method', 'status'))
+request_sql_statements = Histogram(
+    'blp_http_request_sql_statements', "SQL statements executed per HTTP request", ('route', 'method'), STATEMENT_BUCKETS)
+request_sql_duration = Histogram(
+    'blp_http_request_sql_seconds', "Time spent executing SQL statements per HTTP request", ('route', 'method'))
+sql_statements = Counter('blp_sql_statements_total', "SQL statements executed")
+sql_duration = Counter('blp_sql_seconds_total', "Time spent executing SQL statements")
+file_bytes_read = Counter('blp_file_read_bytes_total', "Content bytes read from the filesystem")
+file_bytes_written = Counter('blp_file_written_bytes_total', "Content bytes written to the filesystem")
+access_decisions = Counter('blp_access_decisions_total', "BLP access control decisions", ('rule', 'decision'))
+
+
+def render():
+    """
+    All the metrics in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in this.registry:
+        lines.extend(metric.render())
+
+    return '\n'.join(lines) + '\n'
+
+
+def observe_sql(duration):
+    """
+    Called after every SQL statement (see db_manager)
+    """
+    sql_statements.inc()
+    sql_duration.inc(amount=duration)
+
+    state = this.request_state
+    if getattr(state, 'started', None) is not None:
+        state.statements += 1
+        state.sql_duration += duration
+
+
+def record_access_decision(rule, allowed):
+    access_decisions.inc(rule, 'allow' if allowed else 'deny')
+
+
+def init_app(app):
+    """
+    Times every request of the Flask app, along with the SQL statements that it executed
+    """
+    from flask import request
+
+    @app.before_request
+    def start_request_timer():
+        state = this.request_state
+        state.started = time.perf_counter()
+        state.statements = 0
+        state.sql_duration = 0.0
+
+    @app.after_request
+    def record_request(response):
+        state = this.request_state
+        started = getattr(state, 'started', None)
+        if started is None:
+            return response
+        state.started = None
+
+        # The route's rule (e.g. /files/<filename>) and not the actual path, so that the number of label values is bounded
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_request_duration.observe(time.perf_counter() - started, route, request.method, str(response.status_code))
+        request_sql_statements.observe(state.statements, route, request.method)
+        request_sql_duration.observe(state.sql_duration, route, request.method)
+
+        return response
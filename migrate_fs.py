@@ -0,0 +1,57 @@
+"""
+Offline tool for moving an existing filesystem (e.g. an old flat one) to another shard depth.
+The server must be stopped while it runs. It can safely be run again if it was interrupted.
+
+Usage:
+    python migrate_fs.py --fs-dir fs --shard-depth 2
+"""
+import argparse
+import os
+import file_manager
+
+
+def migrate(fs_dir, shard_depth):
+    old_shard_depth = file_manager.read_layout(fs_dir)
+    moved = 0
+
+    # Walk the whole tree, since an interrupted migration leaves files in both layouts
+    for dirpath, dirnames, filenames in os.walk(fs_dir):
+        # Deduplicated blobs have their own layout
+        if dirpath == fs_dir and file_manager.BLOBS_DIRNAME in dirnames:
+            dirnames.remove(file_manager.BLOBS_DIRNAME)
+
+        for filename in filenames:
+            if dirpath == fs_dir and filename == file_manager.LAYOUT_FILENAME:
+                continue
+
+            old_path = os.path.join(dirpath, filename)
+            new_path = file_manager.get_filepath(filename, fs_dir, shard_depth)
+            if old_path == new_path:
+                continue
+
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.rename(old_path, new_path)
+            moved += 1
+
+    # Remove the shard directories that were left empty (bottom up)
+    for dirpath, dirnames, filenames in os.walk(fs_dir, topdown=False):
+        if dirpath != fs_dir and not os.listdir(dirpath) and file_manager.BLOBS_DIRNAME not in dirpath:
+            os.rmdir(dirpath)
+
+    # Record the new layout only after all the files were moved
+    file_manager.write_layout(fs_dir, shard_depth)
+
+    print("Moved {} files from shard depth {} to {}".format(moved, old_shard_depth, shard_depth))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate a BLP filesystem to another shard depth")
+    parser.add_argument('--fs-dir', default='fs')
+    parser.add_argument('--shard-depth', type=int, default=file_manager.DEFAULT_SHARD_DEPTH)
+    args = parser.parse_args()
+
+    migrate(args.fs_dir, args.shard_depth)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Versioned schema migrations for existing BLP databases.
+
+The schema version is kept in SQLite's PRAGMA user_version.
+Every migration brings the schema from version (index) to version (index + 1), so new migrations must only be appended.
+"""
+
+
+def _add_unique_lookup_indexes(connection):
+    # Unique indexes can't be created while duplicates exist, so fail with a clear message instead of an sqlite error
+    for table, column in (('files', 'filename'), ('users', 'email')):
+        duplicates = connection.execute(
+            'SELECT {column} FROM {table} WHERE {column} IS NOT NULL GROUP BY {column} HAVING COUNT(*) > 1'.format(table=table, column=column)
+        ).fetchall()
+        if duplicates:
+            raise RuntimeError("Can't migrate, {}.{} has duplicate values: {}".format(table, column, [row[0] for row in duplicates]))
+
+    # The index names are the ones that SQLAlchemy generates for index=True columns
+    connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS ix_files_filename ON files (filename)')
+    connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS ix_users_email ON users (email)')
+
+
+def _add_files_owner_index(connection):
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_files_owner_id ON files (owner_id)')
+
+
+def _add_files_blob_column(connection):
+    # The blobs table itself is created by create_all, since it's a new table
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(files)')]
+    if 'blob_sha256' not in columns:
+        connection.execute('ALTER TABLE files ADD COLUMN blob_sha256 VARCHAR REFERENCES blobs (sha256)')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_files_blob_sha256 ON files (blob_sha256)')
+
+
+def _add_compartments_columns(connection):
+    # Existing users and files get an empty set of compartments, so their labels are their levels only
+    for table in ('users', 'files'):
+        columns = [row[1] for row in connection.execute('PRAGMA table_info({})'.format(table))]
+        if 'compartments' not in columns:
+            connection.execute('ALTER TABLE {} ADD COLUMN compartments INTEGER NOT NULL DEFAULT 0'.format(table))
+
+
+def _add_users_kdf_column(connection):
+    # Existing users keep their sha512 hashes (a NULL kdf) until their next login
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(users)')]
+    if 'kdf' not in columns:
+        connection.execute('ALTER TABLE users ADD COLUMN kdf VARCHAR')
+
+
+MIGRATIONS = [
+    _add_unique_lookup_indexes,
+    _add_files_owner_index,
+    _add_files_blob_column,
+    _add_compartments_columns,
+    _add_users_kdf_column,
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def get_version(connection):
+    return connection.execute('PRAGMA user_version').scalar()
+
+
+def upgrade(engine):
+    """
+    Runs all the migrations that weren't applied yet on the DB, each one in its own transaction
+    """
+    with engine.connect() as connection:
+        version = get_version(connection)
+        for index in range(version, LATEST_VERSION):
+            with connection.begin():
+                MIGRATIONS[index](connection)
+                connection.execute('PRAGMA user_version = {}'.format(index + 1))
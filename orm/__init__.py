@@ -4,4 +4,6 @@ Base = declarative_base()
 
 from orm.user import User
 from orm.file import File
+from orm.blob import Blob
+from orm.revoked_user import RevokedUser
 
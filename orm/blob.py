@@ -0,0 +1,20 @@
+from sqlalchemy import Column, Integer, String
+from orm import Base
+
+
+class Blob(Base):
+    __tablename__ = 'blobs'
+
+    # SHA-256 of the content
+    sha256 = Column(String, primary_key=True)
+    # Size on disk
+    size = Column(Integer)
+    # Number of files that point at this blob. A blob with no references is deleted by blob_store's garbage collection
+    refcount = Column(Integer, default=0, nullable=False, index=True)
+
+    def to_dict(self):
+        return {
+            'sha256': self.sha256,
+            'size': self.size,
+            'refcount': self.refcount
+        }
@@ -1,23 +1,28 @@
 from sqlalchemy import Column, Integer, String, Enum, ForeignKey
 from sqlalchemy.orm import relationship
 from orm import Base
-from orm.level import BlpLevel
+from orm.level import BlpLevel, Compartments, NO_COMPARTMENTS, compartment_names
 
 
 class File(Base):
     __tablename__ = 'files'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    filename = Column(String)
+    filename = Column(String, index=True, unique=True)
     level = Column(Enum(BlpLevel), default=BlpLevel.UNCLASSIFIED)
+    compartments = Column(Compartments, default=NO_COMPARTMENTS, nullable=False)
 
-    owner_id = Column(Integer, ForeignKey('users.id'))
+    owner_id = Column(Integer, ForeignKey('users.id'), index=True)
     owner = relationship('User')
 
+    # The deduplicated blob that holds the file's content, if any
+    blob_sha256 = Column(String, ForeignKey('blobs.sha256'), index=True)
+
     def to_dict(self):
         return {
             'id': self.id,
             'filename': self.filename,
             'level': self.level.name,
+            'compartments': compartment_names(self.compartments),
             'owner_id': self.owner_id
         }
@@ -1,4 +1,5 @@
 import enum
+from sqlalchemy.types import TypeDecorator, Integer
 
 
 class BlpLevel(enum.Enum):
@@ -6,3 +7,46 @@ class BlpLevel(enum.Enum):
     RESTRICTED = 1
     SECRET = 2
     TOP_SECRET = 3
+
+
+class BlpCompartment(enum.IntFlag):
+    """
+    The categories of a BLP label. A label's set of compartments is stored as a bitmask of these flags.
+    New compartments must get new bits, since existing bitmasks are stored in the DB.
+    """
+    NATO = 1 << 0
+    CRYPTO = 1 << 1
+    NOFORN = 1 << 2
+    SIGINT = 1 << 3
+    NUCLEAR = 1 << 4
+
+
+NO_COMPARTMENTS = BlpCompartment(0)
+
+
+def compartments_from_names(names):
+    """
+    The bitmask of the given compartment names. Raises KeyError for an unknown name.
+    """
+    compartments = NO_COMPARTMENTS
+    for name in names or []:
+        compartments |= BlpCompartment[name]
+
+    return compartments
+
+
+def compartment_names(compartments):
+    return [compartment.name for compartment in BlpCompartment if compartment & compartments]
+
+
+class Compartments(TypeDecorator):
+    """
+    A set of compartments, stored as an integer bitmask (so it can be tested in SQL with the & operator)
+    """
+    impl = Integer
+
+    def process_bind_param(self, value, dialect):
+        return int(value) if value is not None else None
+
+    def process_result_value(self, value, dialect):
+        return BlpCompartment(value) if value is not None else None
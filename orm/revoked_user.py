@@ -0,0 +1,11 @@
+from sqlalchemy import Column, Integer, Float
+from orm import Base
+
+
+class RevokedUser(Base):
+    __tablename__ = 'revoked_users'
+
+    # Not a foreign key, since the user itself is deleted
+    user_id = Column(Integer, primary_key=True)
+    # Epoch seconds. Tokens of the user that were issued until then are rejected
+    revoked_at = Column(Float, nullable=False, index=True)
@@ -1,7 +1,7 @@
 from sqlalchemy import Column, Integer, String, Enum
 from sqlalchemy.orm import relationship
 from orm import Base
-from orm.level import BlpLevel
+from orm.level import BlpLevel, Compartments, NO_COMPARTMENTS, compartment_names
 
 
 class User(Base):
@@ -10,14 +10,18 @@ class User(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String)
     level = Column(Enum(BlpLevel), default=BlpLevel.UNCLASSIFIED)
-    email = Column(String)
+    compartments = Column(Compartments, default=NO_COMPARTMENTS, nullable=False)
+    email = Column(String, index=True, unique=True)
     password = Column(String)
     salt = Column(String)
+    # The KDF parameters of the password hash (JSON), None for the original salted sha512 hash
+    kdf = Column(String)
 
     def to_dict(self):
         return {
             'id': self.id,
             'name': self.name,
             'email': self.email,
-            'level': self.level.name
+            'level': self.level.name,
+            'compartments': compartment_names(self.compartments)
         }
@@ -0,0 +1,169 @@
+"""
+Password hashing with a slow KDF (PBKDF2 or scrypt from hashlib), off the request threads.
+
+The hashing runs in a process pool, so a burst of logins occupies the pool's processes rather than the server's
+request threads (and doesn't hold the GIL that the file reads need). The number of hashings that are running or
+waiting for a process is bounded: beyond it, hash / verify fail right away with PoolBusy, and the request should be
+retried later. Without init (e.g. in the unit tests), the hashing runs inline on the calling thread.
+
+Every user's KDF parameters are stored with its hash (User.kdf), so the default KDF can be changed at any time.
+Users without parameters have the original salted sha512 hash (auth.pass_to_hash), which is upgraded on their next login.
+"""
+import sys
+import hmac
+import json
+import uuid
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import auth
+
+
+this = sys.modules[__name__]
+this.kdf = None
+this.pool = None
+this.workers = 0
+this.pending = None
+
+KDF_PBKDF2_SHA256 = 'pbkdf2_sha256'
+KDF_SCRYPT = 'scrypt'
+
+DEFAULT_KDFS = {
+    KDF_PBKDF2_SHA256: {'name': KDF_PBKDF2_SHA256, 'iterations': 260000},
+    KDF_SCRYPT: {'name': KDF_SCRYPT, 'n': 2 ** 14, 'r': 8, 'p': 1}
+}
+
+
+class PoolBusy(Exception):
+    """
+    Too many hashings are already running or waiting
+    """
+    pass
+
+
+def init(kdf=KDF_PBKDF2_SHA256, workers=0, max_pending=64):
+    """
+    kdf is the name of a KDF with its default parameters, or a dict of a KDF's name and parameters.
+    workers is the number of hashing processes, 0 for hashing inline on the calling thread.
+    max_pending bounds the number of hashings that are running or waiting for a process.
+    """
+    close()
+
+    this.kdf = dict(DEFAULT_KDFS[kdf]) if isinstance(kdf, str) else dict(kdf)
+    if workers:
+        # Spawned rather than forked processes, since forking a multi-threaded server process isn't safe
+        this.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        this.workers = workers
+        this.pending = threading.BoundedSemaphore(max_pending)
+
+
+def close():
+    if this.pool:
+        this.pool.shutdown()
+        this.pool = None
+        this.workers = 0
+        this.pending = None
+
+
+def _derive(password, salt, kdf):
+    """
+    Runs in the pool's processes, so it must not depend on anything but its arguments
+    """
+    password = password.encode('utf-8')
+    salt = salt.encode('ascii')
+    if kdf['name'] == KDF_PBKDF2_SHA256:
+        return hashlib.pbkdf2_hmac('sha256', password, salt, kdf['iterations']).hex()
+    if kdf['name'] == KDF_SCRYPT:
+        return hashlib.scrypt(password, salt=salt, n=kdf['n'], r=kdf['r'], p=kdf['p'], maxmem=256 * kdf['r'] * kdf['n']).hex()
+
+    raise ValueError("Unknown KDF {}".format(kdf['name']))
+
+
+def _run(password, salt, kdf):
+    if not this.pool:
+        return _derive(password, salt, kdf)
+
+    # Reserve a place in the pool's queue without waiting for one
+    if not this.pending.acquire(blocking=False):
+        raise PoolBusy()
+    try:
+        future = this.pool.submit(_derive, password, salt, kdf)
+    except:
+        this.pending.release()
+        raise
+    future.add_done_callback(lambda f: this.pending.release())
+
+    return future.result()
+
+
+def _current_kdf():
+    return this.kdf or DEFAULT_KDFS[KDF_PBKDF2_SHA256]
+
+
+def hash_password(password):
+    """
+    Hashes a new password with the current KDF.
+    Returns (hashed password, salt, KDF parameters to store with them). Raises PoolBusy.
+    """
+    if not password:
+        raise ValueError("Empty password given")
+
+    salt = uuid.uuid4().hex
+    kdf = _current_kdf()
+
+    return _run(password, salt, kdf), salt, json.dumps(kdf, sort_keys=True)
+
+
+def hash_passwords(passwords):
+    """
+    Hashes many new passwords with the current KDF, in parallel if there's a pool. Returns a list like hash_password's.
+    Instead of failing when the pool is busy, this waits for room, and it keeps at most one hashing per pool process
+    in flight, so that it doesn't fill the pool's queue ahead of the logins.
+    """
+    kdf = _current_kdf()
+    kdf_json = json.dumps(kdf, sort_keys=True)
+    salts = [uuid.uuid4().hex for _ in passwords]
+
+    if not this.pool:
+        return [(_derive(password, salt, kdf), salt, kdf_json) for password, salt in zip(passwords, salts)]
+
+    pending = this.pending
+    in_flight = threading.BoundedSemaphore(this.workers)
+    futures = []
+    for password, salt in zip(passwords, salts):
+        in_flight.acquire()
+        pending.acquire()
+        try:
+            future = this.pool.submit(_derive, password, salt, kdf)
+        except:
+            pending.release()
+            in_flight.release()
+            raise
+        future.add_done_callback(lambda f: (pending.release(), in_flight.release()))
+        futures.append(future)
+
+    return [(future.result(), salt, kdf_json) for future, salt in zip(futures, salts)]
+
+
+def verify_password(password, hashed_password, salt, kdf):
+    """
+    kdf is the stored KDF parameters of the hash, None for the original sha512 hash. Raises PoolBusy.
+    """
+    if not password:
+        return False
+
+    if kdf is None:
+        # The original hash is fast, no need for the pool
+        candidate, _ = auth.pass_to_hash(password, salt)
+    else:
+        candidate = _run(password, salt, json.loads(kdf))
+
+    return hmac.compare_digest(candidate, hashed_password)
+
+
+def needs_upgrade(kdf):
+    """
+    Whether a hash with the given stored KDF parameters should be replaced with a hash of the current KDF
+    """
+    return kdf is None or json.loads(kdf) != _current_kdf()
@@ -0,0 +1,130 @@
+"""
+Opt-in profiling of single requests.
+A request with the ADMIN credential in its X-Blp-Profile header is run under cProfile, and the SQL statements that it
+executed are traced. The results are kept in a bounded ring buffer, that is served by the /admin/profiles endpoints.
+"""
+import sys
+import io
+import time
+import uuid
+import cProfile
+import pstats
+import threading
+from collections import deque
+import auth
+
+
+this = sys.modules[__name__]
+this.profiles = None
+this.profiles_lock = threading.Lock()
+# The profiler and the SQL trace of the request that is handled by the current thread
+this.request_state = threading.local()
+
+PROFILE_HEADER = 'X-Blp-Profile'
+PROFILE_ID_HEADER = 'X-Blp-Profile-Id'
+
+# Number of functions in the printed profile (sorted by cumulative time)
+PROFILE_STATS_LIMIT = 40
+# Longer statements / parameters are truncated in the SQL trace
+MAX_TRACED_SQL_LENGTH = 2000
+
+
+def init(max_profiles=50):
+    with this.profiles_lock:
+        this.profiles = deque(maxlen=max_profiles)
+
+
+def init_app(app, max_profiles=50):
+    """
+    Profiles the requests of the Flask app that ask for it
+    """
+    from flask import request
+
+    init(max_profiles)
+
+    @app.before_request
+    def start_profiler():
+        state = this.request_state
+        state.profiler = None
+        state.sql_trace = None
+
+        # Only an admin may profile a request. The header carries the admin credential, so the request itself
+        # can still be authorized by a user's access token.
+        if not auth.is_admin_token(request.headers.get(PROFILE_HEADER)):
+            return
+
+        state.sql_trace = []
+        state.started = time.perf_counter()
+        state.profiler = cProfile.Profile()
+        state.profiler.enable()
+
+    @app.after_request
+    def record_profile(response):
+        state = this.request_state
+        profiler = getattr(state, 'profiler', None)
+        if profiler is None:
+            return response
+        profiler.disable()
+        duration = time.perf_counter() - state.started
+        sql_trace = state.sql_trace
+        state.profiler = None
+        state.sql_trace = None
+
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILE_STATS_LIMIT)
+
+        profile = {
+            'id': uuid.uuid4().hex,
+            'time': time.time(),
+            'method': request.method,
+            'path': request.path,
+            'route': request.url_rule.rule if request.url_rule else None,
+            'status': response.status_code,
+            'duration': duration,
+            'sql_duration': sum(statement['duration'] for statement in sql_trace),
+            'sql': sql_trace,
+            'profile': stream.getvalue()
+        }
+        with this.profiles_lock:
+            this.profiles.append(profile)
+        response.headers[PROFILE_ID_HEADER] = profile['id']
+
+        return response
+
+
+def record_sql(statement, parameters, duration):
+    """
+    Called after every SQL statement (see db_manager), traces it if the current request is profiled
+    """
+    sql_trace = getattr(this.request_state, 'sql_trace', None)
+    if sql_trace is None:
+        return
+
+    sql_trace.append({
+        'statement': statement[:MAX_TRACED_SQL_LENGTH],
+        'parameters': repr(parameters)[:MAX_TRACED_SQL_LENGTH],
+        'duration': duration
+    })
+
+
+def list_profiles():
+    """
+    Summaries of the captured profiles, the newest first
+    """
+    with this.profiles_lock:
+        profiles = list(this.profiles)
+
+    summary_keys = ('id', 'time', 'method', 'path', 'route', 'status', 'duration', 'sql_duration')
+    return [dict({key: profile[key] for key in summary_keys}, sql_statements=len(profile['sql'])) for profile in reversed(profiles)]
+
+
+def get_profile(profile_id):
+    """
+    Returns the captured profile or None if it doesn't exist (or was already pushed out of the buffer)
+    """
+    with this.profiles_lock:
+        for profile in this.profiles:
+            if profile['id'] == profile_id:
+                return profile
+
+    return None
@@ -1,6 +1,41 @@
+import os
 import main
+import access_cache
 import file_manager
+import db_manager
+import blob_store
+import audit_log
+import password_hasher
 
-main.create_db()
-file_manager.init(False)
-app = main.start_flask()
+# Should match the --threads that gunicorn was started with
+WORKER_THREADS = int(os.environ.get('BLP_WORKER_THREADS', 8))
+# Signs the access tokens, must be the same for all the workers
+SECRET_KEY = os.environ.get('BLP_SECRET_KEY')
+# Seconds that a file's label is cached by a worker, a label change through another worker is enforced after it
+ACCESS_CACHE_MAX_AGE = float(os.environ.get('BLP_ACCESS_CACHE_MAX_AGE', 1.0))
+# Codec for compressing files at rest (zlib / lzma), no compression if not set
+COMPRESSION = os.environ.get('BLP_COMPRESSION') or None
+# Store identical contents once, as content-addressed blobs
+DEDUP = os.environ.get('BLP_DEDUP') == '1'
+# Directory of the audit log of the access decisions, no audit log if not set
+AUDIT_DIR = os.environ.get('BLP_AUDIT_DIR') or None
+# Drop audit records when the audit log is behind, rather than failing the requests with 503
+AUDIT_DROP_WHEN_FULL = os.environ.get('BLP_AUDIT_DROP_WHEN_FULL') == '1'
+# KDF of new password hashes (pbkdf2_sha256 / scrypt), and the processes that run it
+KDF = os.environ.get('BLP_KDF', password_hasher.KDF_PBKDF2_SHA256)
+HASH_WORKERS = int(os.environ.get('BLP_HASH_WORKERS', 2))
+HASH_MAX_PENDING = int(os.environ.get('BLP_HASH_MAX_PENDING', 64))
+
+# Verify that all the workers sign the tokens with the same key, a random key per worker rejects the other workers' tokens
+if not SECRET_KEY:
+    raise RuntimeError("BLP_SECRET_KEY must be set, so that all the workers accept the same access tokens")
+
+main.create_db(engine_profile=db_manager.production_profile(WORKER_THREADS))
+access_cache.init(max_age=ACCESS_CACHE_MAX_AGE)
+file_manager.init(False, durability=file_manager.DURABILITY_BATCH, compression=COMPRESSION, dedup=DEDUP)
+if DEDUP:
+    blob_store.start_gc()
+password_hasher.init(KDF, HASH_WORKERS, HASH_MAX_PENDING)
+if AUDIT_DIR:
+    audit_log.init(AUDIT_DIR, drop_when_full=AUDIT_DROP_WHEN_FULL)
+app = main.start_flask(SECRET_KEY)
@@ -1,10 +1,33 @@
 import os
 import copy
+import json
+import queue
+import random
+import hashlib
+import sqlite3
+import threading
 import urllib.parse
 import pytest
 import main
+import migrations
+import file_manager
+import migrate_fs
+import file_codec
+import blob_store
+import db_manager
+import metrics
+import audit_log
+import blp_rules
+import password_hasher
+import user_import
+import change_feed
+import auth
+import access_cache
 from api_utils import ApiErorrCode
-from orm.level import BlpLevel
+from orm.level import BlpLevel, BlpCompartment
+from orm.blob import Blob
+from orm.user import User
+from orm.file import File
 
 
 @pytest.fixture
@@ -17,6 +40,9 @@ def client():
     # Create a special DB for this UT
     main.create_db(ut_db_filename)
 
+    # A fast KDF for the UTs, hashing inline
+    password_hasher.init({'name': password_hasher.KDF_PBKDF2_SHA256, 'iterations': 1000})
+
     # Init file manager and start a fresh new filesystem
     main.init_filemanager(True)
 
@@ -76,6 +102,11 @@ def create_user(client, data):
     r, s = post(client, '/users', data, access_token='ADMIN')
     assert s == 200
 
+    # Login in order to get an access token for the user
+    login, s = post(client, '/login', {'email': data['email'], 'password': data['password']})
+    assert s == 200
+    r['token'] = login['token']
+
     return r
 
 
@@ -137,6 +168,23 @@ def test_login(client):
     assert s == 200
     assert r['id'] == user_id
 
+    # The access token authorizes requests, a tampered or raw user id doesn't
+    token = r['token']
+    r, s = get(client, '/files', access_token=token)
+    assert s == 200
+    r, s = get(client, '/files', access_token='Bearer {}'.format(token))
+    assert s == 200
+    r, s = get(client, '/files', access_token=token[:-2])
+    assert s == 401
+    r, s = get(client, '/files', access_token=user_id)
+    assert s == 401
+
+    # The ADMIN user has no BLP label, so it can't use the files endpoints
+    r, s = get(client, '/files', access_token='ADMIN')
+    assert s == 401
+    r, s = post(client, '/files', {'filename': 'admin.txt'}, access_token='ADMIN')
+    assert s == 401
+
     # Try to login with wrong password
     r, s = post(client, '/login', {'email': user['email'], 'password': 'SOME WRONG PASSWORD'})
     assert s == 401
@@ -153,35 +201,37 @@ def test_create_delete_files(client):
     }
     r = create_user(client, user1)
     user1['id'] = r['id']
+    user1['token'] = r['token']
 
     # Create the file
     filename = 'edi.txt'
-    r, s = post(client, '/files', {'filename': filename}, access_token=user1['id'])
+    r, s = post(client, '/files', {'filename': filename}, access_token=user1['token'])
 
     # Verify the file's blp level is the same as the owner's level
     assert s == 200
     assert r['level'] == user1['level']
 
     # Verify that the file was actually created on the FS
-    assert os.path.exists(os.path.join('fs', filename)) == True
+    assert os.path.exists(file_manager.get_filepath(filename)) == True
 
     # Create another user
     user2 = copy.deepcopy(user1)
     user2['email'] = "user2@gmail.com"
     r = create_user(client, user2)
     user2['id'] = r['id']
+    user2['token'] = r['token']
 
     # Try to delete the file of user1 by user2
     # Exception should be thrown since the file belongs to user1
-    r, s = delete(client, '/files', {'filename': filename}, access_token=user2['id'])
+    r, s = delete(client, '/files', {'filename': filename}, access_token=user2['token'])
     assert s == 401
 
     # Delete the file by the right user - now it should succeed
-    r, s = delete(client, '/files', {'filename': filename}, access_token=user1['id'])
+    r, s = delete(client, '/files', {'filename': filename}, access_token=user1['token'])
     assert s == 200
 
     # Verify that the file was actually deleted from the FS
-    assert os.path.exists(os.path.join('fs', filename)) == False
+    assert os.path.exists(file_manager.get_filepath(filename)) == False
 
 
 def test_read_write_files(client):
@@ -194,36 +244,37 @@ def test_read_write_files(client):
     }
     r = create_user(client, user1)
     user1['id'] = r['id']
+    user1['token'] = r['token']
 
     # Create the file
     filename = 'edi.txt'
-    r, s = post(client, '/files', {'filename': filename}, access_token=user1['id'])
+    r, s = post(client, '/files', {'filename': filename}, access_token=user1['token'])
     assert s == 200
 
     # Write to the file
     str = "This is the first line,\nand this is the second one."
-    r, s = put(client, '/files', {'filename': filename, 'content': str}, access_token=user1['id'])
+    r, s = put(client, '/files', {'filename': filename, 'content': str}, access_token=user1['token'])
     assert s == 200
 
     # Read the file
-    r, s = get(client, '/files/{}'.format(urllib.parse.quote(filename)), access_token=user1['id'])
+    r, s = get(client, '/files/{}'.format(urllib.parse.quote(filename)), access_token=user1['token'])
     assert s == 200
     assert r['content'] == str
 
     # Write to the file again and verify that the new text overriden the previous one
     str2 = "Writing again."
-    r, s = put(client, '/files', {'filename': filename, 'content': str2}, access_token=user1['id'])
+    r, s = put(client, '/files', {'filename': filename, 'content': str2}, access_token=user1['token'])
     assert s == 200
-    r, s = get(client, '/files/{}'.format(urllib.parse.quote(filename)), access_token=user1['id'])
+    r, s = get(client, '/files/{}'.format(urllib.parse.quote(filename)), access_token=user1['token'])
     assert r['content'] == str2
 
     # Append to the file
     str3 = "\nAppending some text."
-    r, s = patch(client, '/files', {'filename': filename, 'content': str3}, access_token=user1['id'])
+    r, s = patch(client, '/files', {'filename': filename, 'content': str3}, access_token=user1['token'])
     assert s == 200
 
     # Verify that the new text was appended to the end of the file and not overridden it
-    r, s = get(client, '/files/{}'.format(urllib.parse.quote(filename)), access_token=user1['id'])
+    r, s = get(client, '/files/{}'.format(urllib.parse.quote(filename)), access_token=user1['token'])
     assert r['content'] == (str2 + str3)
 
 
@@ -256,29 +307,33 @@ def create_blp_users(client):
     # Create users with different levels
     r = create_user(client, junior)
     junior['id'] = r['id']
+    junior['token'] = r['token']
     r = create_user(client, mid1)
     mid1['id'] = r['id']
+    mid1['token'] = r['token']
     r = create_user(client, mid2)
     mid2['id'] = r['id']
+    mid2['token'] = r['token']
     r = create_user(client, senior)
     senior['id'] = r['id']
+    senior['token'] = r['token']
 
     return junior, mid1, mid2, senior
 
 
-def create_file_and_write(client, user_id, filename, content):
-    r, s = post(client, '/files', {'filename': filename}, access_token=user_id)
+def create_file_and_write(client, access_token, filename, content):
+    r, s = post(client, '/files', {'filename': filename}, access_token=access_token)
     assert s == 200
-    r, s = put(client, '/files', {'filename': filename, 'content': content}, access_token=user_id)
+    r, s = put(client, '/files', {'filename': filename, 'content': content}, access_token=access_token)
     assert s == 200
 
 
-def read_file(client, user_id, filename):
-    return get(client, '/files/{}'.format(urllib.parse.quote(filename)), access_token=user_id)
+def read_file(client, access_token, filename):
+    return get(client, '/files/{}'.format(urllib.parse.quote(filename)), access_token=access_token)
 
 
-def append_file(client, user_id, filename, content):
-    return patch(client, '/files', {'filename': filename, 'content': content}, access_token=user_id)
+def append_file(client, access_token, filename, content):
+    return patch(client, '/files', {'filename': filename, 'content': content}, access_token=access_token)
 
 
 def test_blp_no_read_up(client):
@@ -286,33 +341,33 @@ def test_blp_no_read_up(client):
     junior, mid1, mid2, senior = create_blp_users(client)
 
     # Each user creates a file and writes some text to it
-    create_file_and_write(client, junior['id'], 'unclassified.txt', "Nothing interesting")
-    create_file_and_write(client, mid1['id'], 'secret1.txt', "Something very secret 1")
-    create_file_and_write(client, mid2['id'], 'secret2.txt', "Something very secret 2")
-    create_file_and_write(client, senior['id'], 'topsecret.txt', "Something very very secret")
+    create_file_and_write(client, junior['token'], 'unclassified.txt', "Nothing interesting")
+    create_file_and_write(client, mid1['token'], 'secret1.txt', "Something very secret 1")
+    create_file_and_write(client, mid2['token'], 'secret2.txt', "Something very secret 2")
+    create_file_and_write(client, senior['token'], 'topsecret.txt', "Something very very secret")
 
     # Verify that mid1 can read the file of mid2 and vice versa
-    r, s = read_file(client, mid1['id'], 'secret2.txt')
+    r, s = read_file(client, mid1['token'], 'secret2.txt')
     assert s == 200
-    r, s = read_file(client, mid2['id'], 'secret1.txt')
+    r, s = read_file(client, mid2['token'], 'secret1.txt')
     assert s == 200
 
     # Verify that junior can read his own file
-    r, s = read_file(client, junior['id'], 'unclassified.txt')
+    r, s = read_file(client, junior['token'], 'unclassified.txt')
     assert s == 200
 
     # Verify that senior can read everyone elses files
-    r, s = read_file(client, senior['id'], 'topsecret.txt')
+    r, s = read_file(client, senior['token'], 'topsecret.txt')
     assert s == 200
-    r, s = read_file(client, senior['id'], 'secret1.txt')
+    r, s = read_file(client, senior['token'], 'secret1.txt')
     assert s == 200
-    r, s = read_file(client, senior['id'], 'secret2.txt')
+    r, s = read_file(client, senior['token'], 'secret2.txt')
     assert s == 200
-    r, s = read_file(client, senior['id'], 'unclassified.txt')
+    r, s = read_file(client, senior['token'], 'unclassified.txt')
     assert s == 200
 
     # Verify that junior can't read files above his level
-    r, s = read_file(client, junior['id'], 'secret1.txt')
+    r, s = read_file(client, junior['token'], 'secret1.txt')
     assert s == 401
     assert r['api_result_code'] == ApiErorrCode.UNAUTHORIZED.name
 
@@ -322,33 +377,900 @@ def test_blp_no_write_down(client):
     junior, mid1, mid2, senior = create_blp_users(client)
 
     # Each user creates a file and writes some text to it
-    create_file_and_write(client, junior['id'], 'unclassified.txt', "Nothing interesting")
-    create_file_and_write(client, mid1['id'], 'secret1.txt', "Something very secret 1")
-    create_file_and_write(client, mid2['id'], 'secret2.txt', "Something very secret 2")
-    create_file_and_write(client, senior['id'], 'topsecret.txt', "Something very very secret")
+    create_file_and_write(client, junior['token'], 'unclassified.txt', "Nothing interesting")
+    create_file_and_write(client, mid1['token'], 'secret1.txt', "Something very secret 1")
+    create_file_and_write(client, mid2['token'], 'secret2.txt', "Something very secret 2")
+    create_file_and_write(client, senior['token'], 'topsecret.txt', "Something very very secret")
 
     # Verify that mid1 can write to the file of mid2 and vice versa
     text_to_append = "\nappending write down test text."
-    r, s = append_file(client, mid1['id'], 'secret2.txt', text_to_append)
+    r, s = append_file(client, mid1['token'], 'secret2.txt', text_to_append)
     assert s == 200
-    r, s = append_file(client, mid2['id'], 'secret1.txt', text_to_append)
+    r, s = append_file(client, mid2['token'], 'secret1.txt', text_to_append)
     assert s == 200
 
     # Verify that junior can write to his own file
-    r, s = append_file(client, junior['id'], 'unclassified.txt', text_to_append)
+    r, s = append_file(client, junior['token'], 'unclassified.txt', text_to_append)
     assert s == 200
 
     # Verify that junior can write to everyone elses files
-    r, s = append_file(client, junior['id'], 'topsecret.txt', text_to_append)
+    r, s = append_file(client, junior['token'], 'topsecret.txt', text_to_append)
     assert s == 200
-    r, s = append_file(client, junior['id'], 'secret1.txt', text_to_append)
+    r, s = append_file(client, junior['token'], 'secret1.txt', text_to_append)
     assert s == 200
-    r, s = append_file(client, junior['id'], 'secret2.txt', text_to_append)
+    r, s = append_file(client, junior['token'], 'secret2.txt', text_to_append)
     assert s == 200
-    r, s = append_file(client, junior['id'], 'unclassified.txt', text_to_append)
+    r, s = append_file(client, junior['token'], 'unclassified.txt', text_to_append)
     assert s == 200
 
     # Verify that senior can't read files below his level
-    r, s = append_file(client, senior['id'], 'secret1.txt', text_to_append)
+    r, s = append_file(client, senior['token'], 'secret1.txt', text_to_append)
     assert s == 401
     assert r['api_result_code'] == ApiErorrCode.UNAUTHORIZED.name
+
+
+def test_access_cache(client):
+    # Create user and a file
+    user1 = {
+        'email': 'edibusl@gmail.com',
+        'password': 'Qwer1234!',
+        'name': 'Edi',
+        'level': BlpLevel.SECRET.name
+    }
+    r = create_user(client, user1)
+    user1['id'] = r['id']
+    user1['token'] = r['token']
+    create_file_and_write(client, user1['token'], 'edi.txt', "Some text")
+
+    # Read the file twice, the second read should be decided by the cache
+    r, s = read_file(client, user1['token'], 'edi.txt')
+    assert s == 200
+    stats_before, s = get(client, '/admin/access-cache', access_token='ADMIN')
+    r, s = read_file(client, user1['token'], 'edi.txt')
+    assert s == 200
+    stats_after, s = get(client, '/admin/access-cache', access_token='ADMIN')
+    assert stats_after['files']['hits'] == stats_before['files']['hits'] + 1
+
+    # The file is created again as TOP SECRET by another worker, the stale label is enforced only until it expires
+    with db_manager.session_scope() as session:
+        session.query(File).filter(File.filename == 'edi.txt').update({'level': BlpLevel.TOP_SECRET})
+        session.commit()
+    access_cache.files.max_age = 0
+    r, s = read_file(client, user1['token'], 'edi.txt')
+    assert s == 401
+
+    # Delete the user and verify that its access token doesn't authorize it anymore
+    r, s = delete(client, '/users/{}'.format(user1['id']), None, access_token='ADMIN')
+    assert s == 200
+    r, s = read_file(client, user1['token'], 'edi.txt')
+    assert s == 401
+
+    # Another worker, that didn't handle the deletion, rejects the token too once it reloads the revocations from the DB
+    auth.revoked_users = {}
+    auth.revocations_synced_at = None
+    r, s = read_file(client, user1['token'], 'edi.txt')
+    assert s == 401
+
+
+def test_migrate_existing_db():
+    # Create a DB with the schema that existed before the lookup columns became unique
+    db_filename = 'ut_migrate.db'
+    if os.path.exists(db_filename):
+        os.unlink(db_filename)
+    connection = sqlite3.connect(db_filename)
+    connection.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, name VARCHAR, level VARCHAR(12), email VARCHAR, password VARCHAR, salt VARCHAR)')
+    connection.execute('CREATE TABLE files (id INTEGER PRIMARY KEY, filename VARCHAR, level VARCHAR(12), owner_id INTEGER)')
+    connection.commit()
+    connection.close()
+
+    try:
+        # Migrate it and verify that the unique indexes were created
+        main.create_db(db_filename)
+        connection = sqlite3.connect(db_filename)
+        assert connection.execute('PRAGMA user_version').fetchone()[0] == migrations.LATEST_VERSION
+        indexes = {row[1]: row[2] for row in connection.execute('PRAGMA index_list(files)')}
+        assert indexes['ix_files_filename'] == 1
+
+        # Existing rows are labeled with their levels only
+        columns = {row[1]: row[4] for row in connection.execute('PRAGMA table_info(files)')}
+        assert columns['compartments'] == '0'
+        connection.close()
+    finally:
+        os.unlink(db_filename)
+
+
+def test_production_engine_profile(tmpdir):
+    main.create_db(str(tmpdir.join('prod.db')), db_manager.production_profile(2))
+    with db_manager.session_scope() as session:
+        assert session.execute('PRAGMA journal_mode').scalar() == 'wal'
+        session.add(User(email='edibusl@gmail.com', name='Edi', level=BlpLevel.SECRET))
+        session.commit()
+
+    # More threads than pooled connections, every one of them keeps using its connection meanwhile
+    errors = []
+    def query_users():
+        try:
+            for _ in range(50):
+                with db_manager.session_scope() as session:
+                    assert session.query(User).filter(User.email == 'edibusl@gmail.com').count() == 1
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=query_users) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    db_manager.engine.dispose()
+
+
+def test_stream_files(client):
+    # Create users with different BLP clearance levels
+    junior, mid1, mid2, senior = create_blp_users(client)
+    create_file_and_write(client, mid1['token'], 'secret1.txt', "")
+    url = '/files/{}/content'.format(urllib.parse.quote('secret1.txt'))
+
+    # Upload raw content which is bigger than a single chunk
+    content = os.urandom(file_manager.CHUNK_SIZE * 3 + 17)
+    rv = client.put(url, data=content, headers={'Authorization': mid1['token'], 'Content-Type': 'application/octet-stream'})
+    assert rv.status_code == 200
+
+    # Append raw content
+    rv = client.patch(url, data=b'tail', headers={'Authorization': mid1['token'], 'Content-Type': 'application/octet-stream'})
+    assert rv.status_code == 200
+
+    # Download it back
+    rv = client.get(url, headers={'Authorization': mid1['token']})
+    assert rv.status_code == 200
+    assert rv.data == content + b'tail'
+
+    # A binary upload is still readable as text, with its bytes that aren't utf-8 replaced
+    rv = client.put(url, data=b'\xff\xfe\x00binary', headers={'Authorization': mid1['token'], 'Content-Type': 'application/octet-stream'})
+    assert rv.status_code == 200
+    r, s = read_file(client, mid1['token'], 'secret1.txt')
+    assert s == 200
+    assert r['content'] == '\ufffd\ufffd\x00binary'
+    r, s = post(client, '/files/batch', {'operations': [{'op': 'read', 'filename': 'secret1.txt'}]}, access_token=mid1['token'])
+    assert r['results'][0]['content'] == '\ufffd\ufffd\x00binary'
+
+    # BLP rules still apply on the streaming endpoints
+    rv = client.get(url, headers={'Authorization': junior['token']})
+    assert rv.status_code == 401
+    rv = client.put(url, data=b'data', headers={'Authorization': senior['token'], 'Content-Type': 'application/octet-stream'})
+    assert rv.status_code == 401
+
+
+def test_conditional_and_range_reads(client):
+    # Create user and a file
+    user1 = {
+        'email': 'edibusl@gmail.com',
+        'password': 'Qwer1234!',
+        'name': 'Edi',
+        'level': BlpLevel.SECRET.name
+    }
+    r = create_user(client, user1)
+    user1['id'] = r['id']
+    user1['token'] = r['token']
+    create_file_and_write(client, user1['token'], 'log.txt', "0123456789")
+    url = '/files/{}/content'.format(urllib.parse.quote('log.txt'))
+
+    # Get the file with its ETag
+    rv = client.get(url, headers={'Authorization': user1['token']})
+    assert rv.status_code == 200
+    etag = rv.headers['ETag']
+
+    # The file didn't change, so the server shouldn't send it again
+    rv = client.get(url, headers={'Authorization': user1['token'], 'If-None-Match': etag})
+    assert rv.status_code == 304
+
+    # The JSON representation has its own ETag
+    rv = client.get('/files/log.txt', headers={'Authorization': user1['token'], 'If-None-Match': etag})
+    assert rv.status_code == 200
+    json_etag = rv.headers['ETag']
+    assert json_etag != etag
+    rv = client.get('/files/log.txt', headers={'Authorization': user1['token'], 'If-None-Match': json_etag})
+    assert rv.status_code == 304
+
+    # Read only the tail of the file
+    rv = client.get(url, headers={'Authorization': user1['token'], 'Range': 'bytes=-4'})
+    assert rv.status_code == 206
+    assert rv.data == b'6789'
+    assert rv.headers['Content-Range'] == 'bytes 6-9/10'
+
+    # Byte ranges don't apply to the JSON representation
+    rv = client.get('/files/log.txt', headers={'Authorization': user1['token'], 'Range': 'bytes=2-4'})
+    assert rv.status_code == 200
+    assert rv.get_json()['content'] == '0123456789'
+    assert 'Content-Range' not in rv.headers and 'Accept-Ranges' not in rv.headers
+
+    # An unsatisfiable range
+    rv = client.get(url, headers={'Authorization': user1['token'], 'Range': 'bytes=20-30'})
+    assert rv.status_code == 416
+
+    # Multiple ranges and an If-Range date (no Last-Modified is sent) get the whole file
+    rv = client.get(url, headers={'Authorization': user1['token'], 'Range': 'bytes=0-1,4-5'})
+    assert rv.status_code == 200
+    assert rv.data == b'0123456789'
+    rv = client.get(url, headers={'Authorization': user1['token'], 'Range': 'bytes=0-1', 'If-Range': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+    assert rv.status_code == 200
+    assert rv.data == b'0123456789'
+
+    # After an append the old ETag isn't current anymore
+    r, s = append_file(client, user1['token'], 'log.txt', "abc")
+    rv = client.get(url, headers={'Authorization': user1['token'], 'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.data == b'0123456789abc'
+
+
+def test_batch_operations(client, monkeypatch):
+    # Create users with different BLP clearance levels
+    junior, mid1, mid2, senior = create_blp_users(client)
+    create_file_and_write(client, senior['token'], 'topsecret.txt', "Something very very secret")
+
+    operations = [
+        {'op': 'create', 'filename': 'a.txt'},
+        {'op': 'write', 'filename': 'a.txt', 'content': 'first'},
+        {'op': 'append', 'filename': 'a.txt', 'content': ' second'},
+        {'op': 'read', 'filename': 'a.txt'},
+        {'op': 'create', 'filename': 'a.txt'},
+        {'op': 'read', 'filename': 'topsecret.txt'},
+        {'op': 'read', 'filename': 'missing.txt'},
+        {'op': 'create', 'filename': 'b.txt'},
+        {'op': 'delete', 'filename': 'b.txt'}
+    ]
+    r, s = post(client, '/files/batch', {'operations': operations}, access_token=mid1['token'])
+    assert s == 200
+    results = r['results']
+    assert [result['api_result_code'] for result in results] == [
+        None, None, None, None,
+        ApiErorrCode.FILE_ALREADY_EXISTS.name,
+        ApiErorrCode.UNAUTHORIZED.name,
+        ApiErorrCode.FILE_NOT_EXISTS.name,
+        None, None
+    ]
+    assert results[3]['content'] == 'first second'
+
+    # Verify that the batch was committed
+    r, s = read_file(client, mid2['token'], 'a.txt')
+    assert s == 200
+    assert r['content'] == 'first second'
+    r, s = read_file(client, mid1['token'], 'b.txt')
+    assert r['api_result_code'] == ApiErorrCode.FILE_NOT_EXISTS.name
+
+    # An invalid operation fails alone
+    operations = [{'op': 'write', 'filename': 'a.txt'}, {'op': 'append', 'filename': 'a.txt', 'content': '!'}]
+    r, s = post(client, '/files/batch', {'operations': operations}, access_token=mid1['token'])
+    assert [result['api_result_code'] for result in r['results']] == [ApiErorrCode.UNKNOWN_ERROR.name, None]
+
+    # Verify that the filesystem changes of a batch that failed are undone, including a binary file's
+    r, s = post(client, '/files', {'filename': 'bin.dat'}, access_token=mid1['token'])
+    rv = client.put('/files/bin.dat/content', data=b'\xff\x00', headers={'Authorization': mid1['token'], 'Content-Type': 'application/octet-stream'})
+    assert rv.status_code == 200
+
+    def failing_read(filename):
+        raise IOError("Disk failure")
+    monkeypatch.setattr(file_manager, 'read_file', failing_read)
+    operations = [
+        {'op': 'append', 'filename': 'a.txt', 'content': ' more'},
+        {'op': 'write', 'filename': 'bin.dat', 'content': 'text'},
+        {'op': 'delete', 'filename': 'bin.dat'},
+        {'op': 'create', 'filename': 'c.txt'},
+        {'op': 'read', 'filename': 'c.txt'}
+    ]
+    with pytest.raises(IOError):
+        post(client, '/files/batch', {'operations': operations}, access_token=mid1['token'])
+    monkeypatch.undo()
+    assert file_manager.read_file('a.txt') == 'first second!'
+    with open(file_manager.get_filepath('bin.dat'), 'rb') as fp:
+        assert fp.read() == b'\xff\x00'
+    assert not os.path.exists(file_manager.get_filepath('c.txt'))
+
+    # No kept versions are left behind
+    assert not [filename for _, _, filenames in os.walk(file_manager.fs_dir) for filename in filenames if filename.endswith('.undo')]
+
+def test_list_files(client):
+    # Create users with different BLP clearance levels
+    junior, mid1, mid2, senior = create_blp_users(client)
+
+    # Each user creates a file
+    create_file_and_write(client, junior['token'], 'unclassified.txt', "Nothing interesting")
+    create_file_and_write(client, mid1['token'], 'secret1.txt', "Something very secret 1")
+    create_file_and_write(client, mid2['token'], 'secret2.txt', "Something very secret 2")
+    create_file_and_write(client, senior['token'], 'topsecret.txt', "Something very very secret")
+
+    # The listing contains only the files that the user may read, and is paged
+    r, s = get(client, '/files?limit=2', access_token=mid1['token'])
+    assert s == 200
+    assert [file['filename'] for file in r['files']] == ['unclassified.txt', 'secret1.txt']
+    r, s = get(client, '/files?limit=2&after={}'.format(r['next_cursor']), access_token=mid1['token'])
+    assert [file['filename'] for file in r['files']] == ['secret2.txt']
+    assert r['next_cursor'] is None
+
+    r, s = get(client, '/files', access_token=junior['token'])
+    assert [file['filename'] for file in r['files']] == ['unclassified.txt']
+
+    # Filters
+    r, s = get(client, '/files?owner_id={}'.format(mid2['id']), access_token=senior['token'])
+    assert [file['filename'] for file in r['files']] == ['secret2.txt']
+    r, s = get(client, '/files?level={}'.format(BlpLevel.TOP_SECRET.name), access_token=senior['token'])
+    assert [file['filename'] for file in r['files']] == ['topsecret.txt']
+
+
+def test_migrate_fs_layout(tmpdir):
+    # Create an old, flat filesystem
+    fs_dir = str(tmpdir.join('fs'))
+    os.makedirs(fs_dir)
+    for filename in ('a.txt', 'b.txt'):
+        with open(os.path.join(fs_dir, filename), 'w') as fp:
+            fp.write(filename)
+
+    # The flat layout is still readable as is
+    file_manager.init(False, fs_dir)
+    assert file_manager.shard_depth == 0
+    assert file_manager.read_file('a.txt') == 'a.txt'
+
+    # Migrate it and verify that the files are found in their new place
+    migrate_fs.migrate(fs_dir, 2)
+    file_manager.init(False, fs_dir, shard_depth=2)
+    assert file_manager.read_file('a.txt') == 'a.txt'
+    assert file_manager.read_file('b.txt') == 'b.txt'
+    assert file_manager.get_filepath('a.txt') != os.path.join(fs_dir, 'a.txt')
+    assert not os.path.exists(os.path.join(fs_dir, 'a.txt'))
+
+
+def test_content_cache(client):
+    # Create user and a file
+    user1 = {
+        'email': 'edibusl@gmail.com',
+        'password': 'Qwer1234!',
+        'name': 'Edi',
+        'level': BlpLevel.SECRET.name
+    }
+    r = create_user(client, user1)
+    user1['token'] = r['token']
+    create_file_and_write(client, user1['token'], 'briefing.txt', "Briefing")
+
+    # The second read is served from the cache
+    r, s = read_file(client, user1['token'], 'briefing.txt')
+    r, s = read_file(client, user1['token'], 'briefing.txt')
+    assert r['content'] == "Briefing"
+    stats, s = get(client, '/admin/content-cache', access_token='ADMIN')
+    assert stats['hits'] == 1
+    assert stats['resident_bytes'] == len("Briefing")
+
+    # Writes and appends invalidate the cached content
+    r, s = append_file(client, user1['token'], 'briefing.txt', " updated")
+    r, s = read_file(client, user1['token'], 'briefing.txt')
+    assert r['content'] == "Briefing updated"
+    r, s = put(client, '/files', {'filename': 'briefing.txt', 'content': "New"}, access_token=user1['token'])
+    r, s = read_file(client, user1['token'], 'briefing.txt')
+    assert r['content'] == "New"
+
+
+def test_concurrent_appends(tmpdir):
+    file_manager.init(False, str(tmpdir.join('fs')))
+    file_manager.create_file('log.txt')
+
+    # Many threads append lines to the same file at once
+    def append_lines(thread_index):
+        for i in range(50):
+            file_manager.append_file('log.txt', "{}-{}\n".format(thread_index, i))
+
+    threads = [threading.Thread(target=append_lines, args=(thread_index,)) for thread_index in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Every line was written exactly once, and the lines of each thread are in order
+    lines = file_manager.read_file('log.txt').splitlines()
+    assert len(lines) == 500
+    for thread_index in range(10):
+        assert [line for line in lines if line.startswith('{}-'.format(thread_index))] == ['{}-{}'.format(thread_index, i) for i in range(50)]
+
+
+def test_atomic_batched_writes(tmpdir):
+    file_manager.init(False, str(tmpdir.join('fs')), durability=file_manager.DURABILITY_BATCH)
+    filenames = ['file{}.txt'.format(i) for i in range(20)]
+    for filename in filenames:
+        file_manager.create_file(filename)
+
+    # Concurrent writers, whose directory fsyncs are batched
+    def write(filename):
+        for i in range(5):
+            file_manager.write_file(filename, "{} version {}".format(filename, i))
+
+    threads = [threading.Thread(target=write, args=(filename,)) for filename in filenames]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Every file has its last version and no temporary files were left behind
+    for filename in filenames:
+        assert file_manager.read_file(filename) == "{} version 4".format(filename)
+    for dirpath, dirnames, names in os.walk(str(tmpdir.join('fs'))):
+        assert not [name for name in names if name.endswith('.tmp')]
+
+
+def test_write_at_offset(client):
+    # Create users with different BLP clearance levels
+    junior, mid1, mid2, senior = create_blp_users(client)
+    create_file_and_write(client, mid1['token'], 'secret1.txt', "0123456789")
+    url = '/files/{}/content'.format(urllib.parse.quote('secret1.txt'))
+
+    # Overwrite a few bytes in the middle and extend the file at its end
+    rv = client.put(url + '?offset=3', data=b'abc', headers={'Authorization': mid1['token']})
+    assert rv.status_code == 200
+    rv = client.put(url + '?offset=10', data=b'XY', headers={'Authorization': mid1['token']})
+    assert rv.status_code == 200
+    r, s = read_file(client, mid1['token'], 'secret1.txt')
+    assert r['content'] == "012abc6789XY"
+
+    # Writing beyond the end of the file isn't allowed
+    rv = client.put(url + '?offset=100', data=b'abc', headers={'Authorization': mid1['token']})
+    assert rv.status_code == 400
+    assert rv.get_json()['api_result_code'] == ApiErorrCode.INVALID_OFFSET.name
+
+    # BLP no write down still applies
+    rv = client.put(url + '?offset=0', data=b'abc', headers={'Authorization': senior['token']})
+    assert rv.status_code == 401
+
+
+def test_compression_at_rest(tmpdir):
+    file_manager.init(False, str(tmpdir.join('fs')), compression='zlib', compression_threshold=100)
+    file_manager.create_file('doc.txt')
+
+    # A large document is compressed
+    content = "A classified line of text.\n" * 1000
+    file_manager.write_file('doc.txt', content)
+    info = file_manager.compression_info('doc.txt')
+    assert info['compressed']
+    assert info['content_bytes'] == len(content)
+    assert info['ratio'] > 5
+    assert file_manager.read_file('doc.txt') == content
+
+    # Appends add frames without rewriting the file, ranges are read across frames
+    file_manager.append_file('doc.txt', "appended")
+    file_manager.write_file_stream('doc.txt', [b"streamed"], append=True)
+    content += "appendedstreamed"
+    assert file_manager.read_file('doc.txt') == content
+    assert file_manager.read_file_range('doc.txt', len(content) - 20, len(content)) == content[-20:].encode()
+
+    # In place writes into a compressed file
+    file_manager.write_file_at('doc.txt', 2, [b"CLASSIFIED"])
+    content = content[:2] + "CLASSIFIED" + content[12:]
+    assert file_manager.read_file('doc.txt') == content
+
+    # Small contents aren't compressed, even if they look like a compressed file
+    for small_content in ("short", file_codec.MAGIC.decode('latin-1')):
+        file_manager.write_file('doc.txt', small_content)
+        assert file_manager.read_file_range('doc.txt', 0, 100) == small_content.encode('utf-8')
+    file_manager.write_file('doc.txt', "BLP")
+    file_manager.write_file_stream('doc.txt', [file_codec.MAGIC[3:] + b"tail"], append=True)
+    assert file_manager.read_file_range('doc.txt', 0, 100) == file_codec.MAGIC + b"tail"
+
+
+def get_blob_refcount(digest):
+    with db_manager.session_scope() as session:
+        blob = session.query(Blob).get(digest)
+        return blob.refcount if blob else None
+
+
+def test_dedup_files(client):
+    file_manager.init(True, dedup=True)
+
+    # Create users with different BLP clearance levels
+    junior, mid1, mid2, senior = create_blp_users(client)
+
+    # Two users store identical attachments under different filenames
+    attachment = "The same attachment"
+    create_file_and_write(client, junior['token'], 'a.txt', attachment)
+    create_file_and_write(client, senior['token'], 'b.txt', attachment)
+    digest = hashlib.sha256(attachment.encode('utf-8')).hexdigest()
+    assert os.path.samefile(file_manager.get_filepath('a.txt'), file_manager.get_filepath('b.txt'))
+    assert get_blob_refcount(digest) == 2
+
+    # Overwriting one of them releases its reference
+    r, s = put(client, '/files', {'filename': 'a.txt', 'content': "Something else"}, access_token=junior['token'])
+    assert get_blob_refcount(digest) == 1
+
+    # Appending to the other one doesn't change the blob
+    r, s = append_file(client, senior['token'], 'b.txt', " appended")
+    assert get_blob_refcount(digest) == 0
+    with open(file_manager.get_blob_path(digest)) as fp:
+        assert fp.read() == attachment
+    r, s = read_file(client, senior['token'], 'b.txt')
+    assert r['content'] == attachment + " appended"
+
+    # The unreferenced blob is garbage collected, the blob of a.txt's content isn't
+    assert blob_store.collect_garbage() == 1
+    assert not os.path.exists(file_manager.get_blob_path(digest))
+    r, s = read_file(client, junior['token'], 'a.txt')
+    assert r['content'] == "Something else"
+    other_digest = hashlib.sha256("Something else".encode('utf-8')).hexdigest()
+
+    # Concurrent writes that record their blobs in the opposite order of their renames: the superseded one doesn't
+    # reference its blob, which is still tracked for the garbage collection
+    superseded_digest = file_manager.write_file('a.txt', "Version 1")
+    latest_digest = file_manager.write_file('a.txt', "Version 2")
+    blob_store.update_file_blob('a.txt', latest_digest)
+    blob_store.update_file_blob('a.txt', superseded_digest)
+    with db_manager.session_scope() as session:
+        assert session.query(File).filter(File.filename == 'a.txt').one().blob_sha256 == latest_digest
+    assert get_blob_refcount(superseded_digest) == 0
+    assert blob_store.collect_garbage() == 2
+    assert not os.path.exists(file_manager.get_blob_path(superseded_digest))
+    assert not os.path.exists(file_manager.get_blob_path(other_digest))
+
+    # A blob whose reference count drifted (it's still referenced, but no file is linked to it) is collected too
+    file_manager.write_file('a.txt', "Version 3")
+    assert get_blob_refcount(latest_digest) == 1
+    assert blob_store.collect_garbage() == 1
+    assert not os.path.exists(file_manager.get_blob_path(latest_digest))
+
+
+def test_metrics(client):
+    # The metrics are per process, so only their changes are checked
+    requests_before = metrics.http_request_duration.get_count('/files/<filename>', 'GET', '200')
+    denied_before = metrics.access_decisions.get('read', 'deny')
+    statements_before = metrics.sql_statements.get()
+    written_before = metrics.file_bytes_written.get()
+
+    # Create users with different BLP clearance levels
+    junior, mid1, mid2, senior = create_blp_users(client)
+    create_file_and_write(client, senior['token'], 'top.txt', "Top secret")
+    r, s = read_file(client, senior['token'], 'top.txt')
+    r, s = read_file(client, junior['token'], 'top.txt')
+    assert s == 401
+
+    assert metrics.http_request_duration.get_count('/files/<filename>', 'GET', '200') == requests_before + 1
+    assert metrics.access_decisions.get('read', 'deny') == denied_before + 1
+    assert metrics.sql_statements.get() > statements_before
+    assert metrics.file_bytes_written.get() == written_before + len("Top secret")
+
+    # The route templates are exposed, not the actual paths
+    rv = client.get('/metrics')
+    assert rv.status_code == 200
+    text = rv.get_data(as_text=True)
+    assert '# TYPE blp_http_request_duration_seconds histogram' in text
+    assert 'blp_http_request_duration_seconds_count{route="/files/<filename>",method="GET",status="401"}' in text
+    assert 'blp_http_request_sql_statements_bucket{route="/files",method="POST",le="+Inf"}' in text
+    assert 'blp_access_decisions_total{rule="read",decision="deny"}' in text
+    assert 'top.txt' not in text
+
+
+def test_profile_request(client):
+    user1 = {
+        'email': 'edibusl@gmail.com',
+        'password': 'Qwer1234!',
+        'name': 'Edi',
+        'level': BlpLevel.SECRET.name
+    }
+    r = create_user(client, user1)
+    create_file_and_write(client, r['token'], 'report.txt', "Report")
+
+    # Only requests with the admin credential in the profile header are profiled
+    headers = generate_request_headers(r['token'])
+    rv = client.get('/files/report.txt', headers=dict(headers, **{'X-Blp-Profile': 'not-admin'}))
+    assert 'X-Blp-Profile-Id' not in rv.headers
+    rv = client.get('/files', headers=dict(headers, **{'X-Blp-Profile': 'ADMIN'}))
+    assert rv.get_json()['files'][0]['filename'] == 'report.txt'
+    profile_id = rv.headers['X-Blp-Profile-Id']
+
+    # The profiles are served to admins only
+    profiles, s = get(client, '/admin/profiles', access_token=r['token'])
+    assert s == 401
+    profiles, s = get(client, '/admin/profiles', access_token='ADMIN')
+    assert [profile['id'] for profile in profiles] == [profile_id]
+    assert profiles[0]['route'] == '/files'
+
+    profile, s = get(client, '/admin/profiles/{}'.format(profile_id), access_token='ADMIN')
+    assert profile['status'] == 200
+    assert any('FROM files' in statement['statement'] for statement in profile['sql'])
+    assert 'files_list' in profile['profile']
+
+
+def test_audit_log(client, tmpdir):
+    log_dir = str(tmpdir.join('audit'))
+    audit_log.init(log_dir, segment_max_bytes=1024)
+    try:
+        # Create users with different BLP clearance levels
+        junior, mid1, mid2, senior = create_blp_users(client)
+        create_file_and_write(client, mid1['token'], 'plan.txt', "Plan")
+        r, s = read_file(client, junior['token'], 'plan.txt')
+        r, s = read_file(client, senior['token'], 'plan.txt')
+        r, s = post(client, '/files/batch', {'operations': [{'op': 'append', 'filename': 'plan.txt', 'content': "!"}]}, access_token=junior['token'])
+
+        # Enough records to rotate (and compress) segments
+        for i in range(20):
+            r, s = read_file(client, senior['token'], 'plan.txt')
+        audit_log.flush()
+        assert any(filename.endswith('.jsonl.gz') for filename in os.listdir(log_dir))
+
+        records = list(audit_log.query(log_dir, user_id=junior['id']))
+        assert [(record['operation'], record['allowed']) for record in records] == [
+            ('gw_endpoints.files_read', False),
+            ('batch:append', True)
+        ]
+        assert records[0]['user_level'] == junior['level'] and records[0]['file_level'] == mid1['level']
+        assert records[0]['user_compartments'] == [] and records[0]['file_compartments'] == []
+        assert len(list(audit_log.query(log_dir, filename='plan.txt'))) == 24
+
+        # Time range queries skip the segments that are out of range
+        assert list(audit_log.query(log_dir, until=records[0]['time'] - 1)) == []
+        assert len(list(audit_log.query(log_dir, since=records[1]['time']))) == 21
+
+        # When the queue stays full, the request fails rather than go unaudited, unless dropping was opted in
+        full_queue = queue.Queue(maxsize=1)
+        full_queue.put({})
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            monkeypatch.setattr(audit_log, 'records_queue', full_queue)
+            monkeypatch.setattr(audit_log, 'put_timeout', 0.01)
+            r, s = read_file(client, senior['token'], 'plan.txt')
+            assert s == 503
+            assert r['api_result_code'] == ApiErorrCode.BUSY.name
+
+            monkeypatch.setattr(audit_log, 'drop_when_full', True)
+            dropped = audit_log.dropped_records.get()
+            r, s = read_file(client, senior['token'], 'plan.txt')
+            assert s == 200
+            assert audit_log.dropped_records.get() == dropped + 1
+    finally:
+        audit_log.close()
+
+
+def test_compartments(client):
+    # Create users with levels and compartments
+    nato_secret = {
+        'email': 'nato@gmail.com',
+        'password': 'Qwer1234!',
+        'name': 'Nato',
+        'level': BlpLevel.SECRET.name,
+        'compartments': ['NATO']
+    }
+    top_secret = {
+        'email': 'top@gmail.com',
+        'password': 'Qwer1234!',
+        'name': 'Top',
+        'level': BlpLevel.TOP_SECRET.name
+    }
+    nato_crypto_top_secret = {
+        'email': 'crypto@gmail.com',
+        'password': 'Qwer1234!',
+        'name': 'Crypto',
+        'level': BlpLevel.TOP_SECRET.name,
+        'compartments': ['NATO', 'CRYPTO']
+    }
+    for user in (nato_secret, top_secret, nato_crypto_top_secret):
+        r = create_user(client, user)
+        user['token'] = r['token']
+        assert r['compartments'] == user.get('compartments', [])
+
+    r, s = post(client, '/users', dict(top_secret, email='x@gmail.com', compartments=['UNKNOWN']), access_token='ADMIN')
+    assert s == 400
+
+    # The file gets its creator's label
+    r, s = post(client, '/files', {'filename': 'nato.txt'}, access_token=nato_secret['token'])
+    assert r['compartments'] == ['NATO']
+    r, s = put(client, '/files', {'filename': 'nato.txt', 'content': "Nato"}, access_token=nato_secret['token'])
+    assert s == 200
+
+    # No read up: a higher level without the file's compartments doesn't dominate the file's label
+    r, s = read_file(client, top_secret['token'], 'nato.txt')
+    assert s == 401
+    r, s = read_file(client, nato_crypto_top_secret['token'], 'nato.txt')
+    assert r['content'] == "Nato"
+
+    # No write down: a label with more compartments is dominated by neither
+    r, s = put(client, '/files', {'filename': 'nato.txt', 'content': "Leak"}, access_token=nato_crypto_top_secret['token'])
+    assert s == 401
+    r, s = put(client, '/files', {'filename': 'nato.txt', 'content': "Nato 2"}, access_token=top_secret['token'])
+    assert s == 401
+
+    # The listing applies the same rule in SQL
+    r, s = get(client, '/files', access_token=top_secret['token'])
+    assert r['files'] == []
+    r, s = get(client, '/files?compartments=NATO', access_token=nato_crypto_top_secret['token'])
+    assert [file['filename'] for file in r['files']] == ['nato.txt']
+    r, s = get(client, '/files?compartments=NATO,CRYPTO', access_token=nato_crypto_top_secret['token'])
+    assert r['files'] == []
+
+    # Batch operations too
+    r, s = post(client, '/files/batch', {'operations': [{'op': 'read', 'filename': 'nato.txt'}]}, access_token=top_secret['token'])
+    assert r['results'][0]['api_result_code'] == ApiErorrCode.UNAUTHORIZED.name
+
+
+def test_bulk_access_matrix(client):
+    # The bulk evaluation agrees with the pairwise rules, also across chunks
+    random.seed(7)
+    levels = list(BlpLevel)
+    users = [(random.choice(levels), BlpCompartment(random.randrange(8))) for _ in range(30)]
+    files = [(random.choice(levels), BlpCompartment(random.randrange(8))) for _ in range(40)]
+    chunks = list(blp_rules.iter_access_matrices(
+        [level.value for level, compartments in users], [level.value for level, compartments in files],
+        [int(compartments) for level, compartments in users], [int(compartments) for level, compartments in files],
+        max_cells=100
+    ))
+    assert len(chunks) > 1
+    for start, read, write in chunks:
+        for i in range(len(read)):
+            user_level, user_compartments = users[start + i]
+            for j, (file_level, file_compartments) in enumerate(files):
+                assert read[i][j] == blp_rules.enforce_blp_read(user_level, file_level, user_compartments, file_compartments)
+                assert write[i][j] == blp_rules.enforce_blp_write(user_level, file_level, user_compartments, file_compartments)
+
+    # The admin endpoint streams a line per user
+    junior, mid1, mid2, senior = create_blp_users(client)
+    create_file_and_write(client, junior['token'], 'public.txt', "Public")
+    create_file_and_write(client, mid1['token'], 'secret.txt', "Secret")
+    r, s = get(client, '/admin/access-matrix', access_token=junior['token'])
+    assert s == 401
+
+    rv = client.get('/admin/access-matrix', headers=generate_request_headers('ADMIN'))
+    counts = {line['user_id']: (line['readable'], line['writable']) for line in map(json.loads, rv.get_data(as_text=True).splitlines())}
+    assert counts == {junior['id']: (1, 2), mid1['id']: (2, 1), mid2['id']: (2, 1), senior['id']: (2, 0)}
+
+    rv = client.get('/admin/access-matrix?mode=matrix', headers=generate_request_headers('ADMIN'))
+    lines = [json.loads(line) for line in rv.get_data(as_text=True).splitlines()]
+    assert len(lines[0]['read']) == 1 and len(lines[0]['write']) == 2
+
+
+def test_password_kdf(client):
+    user1 = {
+        'email': 'edibusl@gmail.com',
+        'password': 'Qwer1234!',
+        'name': 'Edi',
+        'level': BlpLevel.SECRET.name
+    }
+    r = create_user(client, user1)
+
+    # A user with the original sha512 hash
+    hashed_password, salt = auth.pass_to_hash('Old1234!')
+    with db_manager.session_scope() as session:
+        session.add(User(name='Old', email='old@gmail.com', password=hashed_password, salt=salt, level=BlpLevel.SECRET))
+        session.commit()
+
+    # Its hash is upgraded to the current KDF on its first successful login only
+    r, s = post(client, '/login', {'email': 'old@gmail.com', 'password': 'Wrong1234!'})
+    assert s == 401
+    with db_manager.session_scope() as session:
+        assert session.query(User).filter(User.email == 'old@gmail.com').one().kdf is None
+    r, s = post(client, '/login', {'email': 'old@gmail.com', 'password': 'Old1234!'})
+    assert s == 200
+    with db_manager.session_scope() as session:
+        user = session.query(User).filter(User.email == 'old@gmail.com').one()
+        assert json.loads(user.kdf)['name'] == password_hasher.KDF_PBKDF2_SHA256
+        assert user.password != hashed_password
+    r, s = post(client, '/login', {'email': 'old@gmail.com', 'password': 'Old1234!'})
+    assert s == 200
+
+    # Hashing in a pool, which rejects hashings beyond its queue depth
+    password_hasher.init({'name': password_hasher.KDF_SCRYPT, 'n': 2 ** 10, 'r': 8, 'p': 1}, workers=1, max_pending=1)
+    try:
+        password_hasher.pending.acquire()
+        r, s = post(client, '/login', {'email': user1['email'], 'password': user1['password']})
+        assert s == 503
+        assert r['api_result_code'] == ApiErorrCode.BUSY.name
+        password_hasher.pending.release()
+
+        r, s = post(client, '/login', {'email': user1['email'], 'password': user1['password']})
+        assert s == 200
+        with db_manager.session_scope() as session:
+            assert json.loads(session.query(User).filter(User.email == user1['email']).one().kdf)['name'] == password_hasher.KDF_SCRYPT
+    finally:
+        password_hasher.close()
+
+
+def test_import_users(client):
+    user1 = {
+        'email': 'edibusl@gmail.com',
+        'password': 'Qwer1234!',
+        'name': 'Edi',
+        'level': BlpLevel.SECRET.name
+    }
+    create_user(client, user1)
+
+    # Rows that are created, an existing user, a duplicate in the input and invalid rows
+    csv_input = (
+        "email,password,name,level,compartments\n"
+        "a@gmail.com,Pass1234!,A,SECRET,NATO;CRYPTO\n"
+        "edibusl@gmail.com,Pass1234!,Edi,SECRET,\n"
+        "b@gmail.com,Pass1234!,B,UNCLASSIFIED,\n"
+        "a@gmail.com,Pass1234!,A2,SECRET,\n"
+        "c@gmail.com,,C,SECRET,\n"
+        "d@gmail.com,Pass1234!,D,COSMIC,\n"
+    )
+    rv = client.post('/users/import?format=csv', data=csv_input, headers={'Authorization': 'ADMIN', 'Content-Type': 'text/csv'})
+    assert rv.status_code == 200
+    reports = [json.loads(line) for line in rv.get_data(as_text=True).splitlines()]
+    assert [(report['row'], report['api_result_code']) for report in reports] == [
+        (1, None),
+        (2, ApiErorrCode.USER_EXISTS.name),
+        (3, None),
+        (4, ApiErorrCode.USER_EXISTS.name),
+        (5, ApiErorrCode.UNKNOWN_ERROR.name),
+        (6, ApiErorrCode.UNKNOWN_ERROR.name)
+    ]
+
+    # The imported users can log in, with their labels
+    r, s = post(client, '/login', {'email': 'a@gmail.com', 'password': 'Pass1234!'})
+    assert r['id'] == reports[0]['id']
+    r, s = post(client, '/files', {'filename': 'a.txt'}, access_token=r['token'])
+    assert r['compartments'] == ['NATO', 'CRYPTO']
+
+    # JSON lines, in chunks
+    rows = [{'email': 'user{}@gmail.com'.format(i), 'password': 'Pass1234!', 'name': 'U', 'level': 'SECRET'} for i in range(7)]
+    reports = list(user_import.import_users(rows + [rows[0]], chunk_size=3))
+    assert [report['api_result_code'] for report in reports] == [None] * 7 + [ApiErorrCode.USER_EXISTS.name]
+    assert len({report['id'] for report in reports[:7]}) == 7
+
+
+def read_change_events(rv, count):
+    """
+    Reads server-sent events from a streamed response until count events (that aren't keepalives) were read
+    """
+    events = []
+    data = ''
+    for chunk in rv.response:
+        data += chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+        while '\n\n' in data:
+            block, data = data.split('\n\n', 1)
+            fields = dict(line.split(': ', 1) for line in block.splitlines() if not line.startswith(':'))
+            if 'event' in fields:
+                events.append({'id': fields['id'], 'event': fields['event'], 'data': json.loads(fields['data'])})
+        if len(events) >= count:
+            return events
+
+    return events
+
+
+def test_change_feed(client):
+    # Keepalives that don't hold the test
+    change_feed.init(keepalive_interval=0.1)
+    junior, mid1, mid2, senior = create_blp_users(client)
+
+    # Subscribe before the changes
+    junior_rv = client.get('/changes', headers=generate_request_headers(junior['token']), buffered=False)
+    admin_rv = client.get('/changes', headers=generate_request_headers('ADMIN'), buffered=False)
+    assert junior_rv.status_code == 200
+    assert junior_rv.mimetype == 'text/event-stream'
+
+    create_file_and_write(client, junior['token'], 'junior.txt', 'a')
+    create_file_and_write(client, senior['token'], 'senior.txt', 'b')
+    r, s = append_file(client, junior['token'], 'junior.txt', 'c')
+    assert s == 200
+
+    # Filtering the events for the subscribers isn't counted as access decisions
+    read_decisions = metrics.access_decisions.get('read', 'allow') + metrics.access_decisions.get('read', 'deny')
+    change_feed.publish(change_feed.EVENT_WRITE, 'senior.txt', BlpLevel.TOP_SECRET, BlpCompartment(0), senior['id'])
+    assert metrics.access_decisions.get('read', 'allow') + metrics.access_decisions.get('read', 'deny') == read_decisions
+    r, s = post(client, '/files/batch', {'operations': [{'op': 'create', 'filename': 'batch.txt'}, {'op': 'delete', 'filename': 'batch.txt'}]}, access_token=junior['token'])
+    assert s == 200
+
+    # Verify that the junior gets only the changes of files that it may read (BLP no read up)
+    events = read_change_events(junior_rv, 5)
+    assert [(event['event'], event['data']['filename']) for event in events] == [
+        ('create', 'junior.txt'), ('write', 'junior.txt'), ('append', 'junior.txt'), ('create', 'batch.txt'), ('delete', 'batch.txt')
+    ]
+    assert events[0]['data']['user_id'] == junior['id']
+    junior_rv.close()
+
+    # The ADMIN gets all the changes
+    events = read_change_events(admin_rv, 8)
+    assert [event['data']['filename'] for event in events].count('senior.txt') == 3
+    admin_rv.close()
+
+    # Resume after the junior's first event, from the history
+    headers = dict(generate_request_headers(junior['token']), **{'Last-Event-ID': events[0]['id']})
+    rv = client.get('/changes', headers=headers, buffered=False)
+    assert [event['event'] for event in read_change_events(rv, 4)] == ['write', 'append', 'create', 'delete']
+    rv.close()
+
+    # An id that can't be resumed gets a reset event
+    headers = dict(generate_request_headers(junior['token']), **{'Last-Event-ID': 'unknown-1'})
+    rv = client.get('/changes', headers=headers, buffered=False)
+    assert [event['event'] for event in read_change_events(rv, 1)] == ['reset']
+    rv.close()
+    assert not change_feed.subscribers
@@ -0,0 +1,177 @@
+"""
+Bulk import of users from a CSV or a JSON lines stream.
+
+Rows are processed in chunks, so only one chunk is held in memory at a time, however large the input is.
+For every chunk, the existing emails are checked with a single IN query, the passwords are hashed in parallel
+(by password_hasher's pool) and the new users are inserted with a bulk insert in a single transaction.
+A report line is yielded for every row, in the input's order.
+
+CSV input has a header row with the columns email, password, name, level and optionally compartments (separated by ;).
+JSON lines input has an object per line with the same keys (compartments is a list).
+
+Usage:
+    python user_import.py --db blp.db --format csv users.csv
+"""
+import sys
+import io
+import csv
+import json
+import argparse
+from sqlalchemy.exc import IntegrityError
+import db_manager
+import password_hasher
+from api_utils import ApiErorrCode
+from orm.user import User
+from orm.level import BlpLevel, compartments_from_names
+
+
+FORMAT_CSV = 'csv'
+FORMAT_JSONL = 'jsonl'
+
+# Rows per chunk (one IN query, one batch of hashing and one transaction), below sqlite's limit of bound parameters
+DEFAULT_CHUNK_SIZE = 500
+
+REQUIRED_FIELDS = ('email', 'password', 'name', 'level')
+
+
+def iter_rows(text_stream, input_format):
+    """
+    Yields the rows of the input as dicts, one at a time
+    """
+    if input_format == FORMAT_CSV:
+        for row in csv.DictReader(text_stream):
+            compartments = row.get('compartments')
+            row['compartments'] = [name for name in compartments.split(';') if name] if compartments else []
+            yield row
+    elif input_format == FORMAT_JSONL:
+        for line in text_stream:
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            # An invalid line is reported as an invalid row
+            yield row if isinstance(row, dict) else {}
+    else:
+        raise ValueError("Unknown format {}".format(input_format))
+
+
+def _parse_row(row):
+    """
+    Returns (user mapping without the password hash, error message)
+    """
+    missing = [field for field in REQUIRED_FIELDS if not row.get(field)]
+    if missing:
+        return None, "Missing {}".format(', '.join(missing))
+
+    try:
+        level = BlpLevel[row['level']]
+    except KeyError:
+        return None, "Unknown level {}".format(row['level'])
+    try:
+        compartments = compartments_from_names(row.get('compartments'))
+    except KeyError as e:
+        return None, "Unknown compartment {}".format(e.args[0])
+
+    return {'email': row['email'], 'name': row['name'], 'level': level, 'compartments': compartments}, None
+
+
+def import_users(rows, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Creates the users of the rows. Yields a report per row: its number (starting at 1), its email and its
+    api_result_code (None if created, USER_EXISTS or UNKNOWN_ERROR for an invalid row), with the new user's id or a message.
+    """
+    chunk = []
+    for row_number, row in enumerate(rows, start=1):
+        chunk.append((row_number, row))
+        if len(chunk) >= chunk_size:
+            for report in _import_chunk(chunk):
+                yield report
+            chunk = []
+
+    if chunk:
+        for report in _import_chunk(chunk):
+            yield report
+
+
+def _import_chunk(chunk):
+    reports = {}
+    users = {}
+    emails = set()
+    for row_number, row in chunk:
+        user, error = _parse_row(row)
+        if error:
+            reports[row_number] = {'row': row_number, 'email': row.get('email'), 'api_result_code': ApiErorrCode.UNKNOWN_ERROR.name, 'message': error}
+        elif user['email'] in emails:
+            # A duplicate within the chunk
+            reports[row_number] = _exists_report(row_number, user['email'])
+        else:
+            emails.add(user['email'])
+            users[row_number] = dict(user, password=row['password'])
+
+    with db_manager.session_scope() as session:
+        # Check all the emails of the chunk with a single query
+        existing = {email for email, in session.query(User.email).filter(User.email.in_(list(emails)))}
+        for row_number in [row_number for row_number, user in users.items() if user['email'] in existing]:
+            reports[row_number] = _exists_report(row_number, users.pop(row_number)['email'])
+
+        # Hash the passwords of the new users in parallel
+        hashes = password_hasher.hash_passwords([user['password'] for user in users.values()])
+        for user, (hashed_password, salt, kdf) in zip(users.values(), hashes):
+            user.update(password=hashed_password, salt=salt, kdf=kdf)
+
+        try:
+            session.bulk_insert_mappings(User, list(users.values()))
+            session.commit()
+        except IntegrityError:
+            # A user was created meanwhile by someone else, insert the chunk's users one by one
+            session.rollback()
+            for row_number, user in list(users.items()):
+                try:
+                    session.bulk_insert_mappings(User, [user])
+                    session.commit()
+                except IntegrityError:
+                    session.rollback()
+                    reports[row_number] = _exists_report(row_number, users.pop(row_number)['email'])
+
+        # The bulk insert doesn't fetch the new ids
+        ids = dict(session.query(User.email, User.id).filter(User.email.in_([user['email'] for user in users.values()])))
+        for row_number, user in users.items():
+            reports[row_number] = {'row': row_number, 'email': user['email'], 'api_result_code': None, 'id': ids.get(user['email'])}
+
+    for row_number, row in chunk:
+        yield reports[row_number]
+
+
+def _exists_report(row_number, email):
+    return {'row': row_number, 'email': email, 'api_result_code': ApiErorrCode.USER_EXISTS.name, 'message': "User {} already exists".format(email)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import users from CSV / JSON lines, prints a JSON line report per row")
+    parser.add_argument('input', help="Input file, - for stdin")
+    parser.add_argument('--format', choices=[FORMAT_CSV, FORMAT_JSONL], default=FORMAT_CSV)
+    parser.add_argument('--db', default=None)
+    parser.add_argument('--kdf', default=password_hasher.KDF_PBKDF2_SHA256)
+    parser.add_argument('--workers', type=int, default=4, help="Password hashing processes")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    # Imported here, since main imports the endpoints, which import this module
+    import main as blp_main
+
+    # Without echo, which would mix the SQL log into the report
+    blp_main.create_db(args.db, db_manager.EngineProfile(echo=False))
+    password_hasher.init(args.kdf, args.workers)
+    try:
+        text_stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='') if args.input == '-' else open(args.input, encoding='utf-8', newline='')
+        with text_stream:
+            for report in import_users(iter_rows(text_stream, args.format), args.chunk_size):
+                print(json.dumps(report))
+    finally:
+        password_hasher.close()
+
+
+if __name__ == '__main__':
+    main()